@@ -23,13 +23,26 @@ import os
 import sys
 import Solex_recon as sol
 from astropy.io import fits
-import cProfile
 import PySimpleGUI as sg
 import traceback
 import cv2
 import json
+import time
+import queue
+import multiprocessing
+import batch_manifest
+import watch_folder
+import solex_server
+import stack_scans
+import mosaic
+import profiling
 
 serfiles = []
+watch_dirs = []
+workers = 1
+server_port = None
+profile_top = None # --profile: number of functions in the table printed after each file
+BATCH_STOP_TIMEOUT = 60 # seconds the GUI closed during a batch waits for the current file to stop
 
 options = {
     'shift':[0],
@@ -49,10 +62,32 @@ options = {
     'fixed_width': None,
     'poly_fit': None,
     'doppler': None,
-    'doppler_picture': None,
+    'doppler_picture': 0,
+    'doppler_sweep': False, # dopplergrams for all the symmetric pairs of pixel shifts
+    'precision': 'float32', # working float type for geometry and contrast ('float64' for the reference path, see regression_check)
+    'line_fit_frames': 200, # frames sampled for the spectral line detection (None for all frames)
+    'line_drift': 0, # measure the line drift every n frames and follow it (0 for a fixed line fit)
+    'write_files': True, # write png, fits and log files next to the video file
+    'keep_arrays': False, # return all the images as arrays from Solex_recon.solex_proc
+    'resume': False, # skip files already processed with the same options, resume interrupted files from their checkpoint
+    'checkpoint_frames': 0, # save the reconstruction every n frames to resume a killed job (0 for no checkpoint)
+    'frames': None, # [first, last] frames to process (None for all frames)
+    'trim_frames': True, # process only the frames where the Sun crosses the slit
+    'colour_channel': 'lum', # colour files: 'R', 'G' or 'B' channel, or 'lum' for all of them
+    'scan_speed': None, # scan speed (arcsec per second) to compute the Y/X ratio from the SER time stamps
+    'focal_length': None, # focal length (mm) of the telescope, for the pixel scale
+    'session_geometry': 0, # reuse the Y/X ratio and tilt of the first n files of a session for the next ones (0 to fit every file)
+    'mosaic': False, # the files are partial scans of the disk, assembled in a mosaic
+    'stack': None, # stack the files processed together: 'mean', 'median' or 'sigma' (sigma-clipped mean), None for no stacking
+    'velocity_map': 0, # line centre map: half-width k of the search for the line minimum around the line fit (0 for no map)
+    'quick_look': 0, # only a quick look png of each file, from one frame in every n frames and rows binned by n (0 for the full processing)
 
 }
 
+# options without a GUI field or CLI flag: only set in the SHG_config file, also read in CLI mode
+CONFIG_FILE_OPTIONS = ('precision', 'line_fit_frames', 'line_drift', 'checkpoint_frames', 'trim_frames', 'colour_channel',
+                       'scan_speed', 'focal_length', 'session_geometry', 'velocity_map')
+
 flag_dictionnary = { #add True/False flag here. Managed near line 147
     'd' : 'flag_display', #True False display all pictures
     'c' : 'clahe_only',  #True/False
@@ -61,14 +96,17 @@ flag_dictionnary = { #add True/False flag here. Managed near line 147
     'w' : 'shift',
     's' : 'crop_width_square', # True / False
     't' : 'transversalium', # True / False
-    'm' : 'flip_x' # True / False
+    'm' : 'flip_x', # True / False
+    'R' : 'resume', # True / False
+    'M' : 'mosaic', # True / False
+    'v' : 'doppler_sweep' # True / False
 
 }
 
 
 
 def usage():
-    usage_ = "SHG_MAIN.py [-dcfpstwmpf] [file(s) to treat, * allowed]\n"
+    usage_ = "SHG_MAIN.py [-dcfpstwmpfj] [file(s) to treat, * allowed] [directory to watch]\n"
     usage_ += "'d' : 'flag_display', display all graphics (False by default)\n"
     usage_ += "'c' : 'clahe_only',  only final clahe image is saved (False by default)\n"
     usage_ += "'f' : 'save_fit', save all fits files (False by default)\n"
@@ -76,16 +114,27 @@ def usage():
     usage_ += "'p' : 'no disk_display' turn off black disk with protuberance images (False by default)\n"
     usage_ += "'s' : 'crop_square_width', crop the width to equal the height (False by default)\n"
     usage_ += "'t' : 'disable transversalium', disable transversalium correction (False by default)\n"
+    usage_ += "'R' : 'resume', skip files already processed with the same options and resume interrupted ones (False by default)\n"
     usage_ += "'w' : 'a,b,c'  produce images at a, b and c pixels from minima\n"
     usage_ += "'w' : 'x:y:w'  produce images starting at x, finishing at y, every w pixels from minima\n"
     #usage_ += "'P' : 'a,b,c'  using polynome a*x²+b*x+c or a*x³+b*x²+c*x+d as fitting\n"
     usage_ += "'D' : 'n'      produce 4 pictures, from -n pixels, n pixel from minimum and a mean of 2 and a dopplergram\n"
-    usage_ += "'r' : 'w'  crop width to a constant no. of pixels."
+    usage_ += "'v' : 'doppler_sweep', produce a dopplergram for every pair of shifts -n, n of the 'w' shifts (False by default)\n"
+    usage_ += "'r' : 'w'  crop width to a constant no. of pixels.\n"
+    usage_ += "'M' : 'mosaic', the files are partial scans of the disk, assembled in a mosaic (False by default)\n"
+    usage_ += "'q' : 'n'  quick look: only a small preview png from one frame in every n frames (4 if not given)\n"
+    usage_ += "'k' : 'method'  stack the files after registration, method is mean (default), median or sigma (sigma-clipped mean)\n"
+    usage_ += "'j' : 'n'  number of files processed in parallel in watch-folder or service mode (1 by default)\n"
+    usage_ += "'S' : 'port'  run a local HTTP/JSON processing service on this port (8765 if not given)\n"
+    usage_ += "'--frames a:b' process only the frames a to b (by default the frames without the Sun are skipped)\n"
+    usage_ += "'--profile' or '--profile=n' profile the processing of each file: pstats dump, collapsed stacks for flame graphs and table of the n slowest functions (25 by default)\n"
+    usage_ += "directories instead of files: watch them and process each new SER/AVI file once it is completely written"
     #usage_ += "'g' : DOESN'T WORK ->  Dopplergram using base polynome, compute and display difference between minima \n"
     return usage_
 
 def treat_flag_at_cli(arguments):
     """read cli arguments and produce options variable"""
+    global workers, server_port
     #reading arguments
     i=0
     while i < len(argument[1:]): #there's a '-' at first)
@@ -160,6 +209,40 @@ def treat_flag_at_cli(arguments):
             except IndexError:
                 i+=1 #the reach the end of arguments.
             options['fixed_width'] = int(fw)
+        elif character=='j':
+            nw = ''
+            try:
+                while argument[1:][i+1].isdigit():
+                    nw += argument[1:][i+1]
+                    i += 1
+                i += 1
+            except IndexError:
+                i+=1 #the reach the end of arguments.
+            workers = int(nw)
+        elif character=='S':
+            port = ''
+            try:
+                while argument[1:][i+1].isdigit():
+                    port += argument[1:][i+1]
+                    i += 1
+                i += 1
+            except IndexError:
+                i+=1 #the reach the end of arguments.
+            server_port = int(port) if port else 8765
+        elif character=='q':
+            step = ''
+            try:
+                while argument[1:][i+1].isdigit():
+                    step += argument[1:][i+1]
+                    i += 1
+                i += 1
+            except IndexError:
+                i+=1 #the reach the end of arguments.
+            options['quick_look'] = int(step) if step else sol.QUICK_LOOK_STEP
+        elif character=='k':
+            rest = argument[1:][i+1:]
+            options['stack'] = next((m for m in stack_scans.STACK_METHODS if rest.startswith(m)), 'mean')
+            i += 1 + (len(options['stack']) if rest.startswith(options['stack']) else 0)
         elif character=='g':
             options['doppler'] = True
             i+=1
@@ -178,15 +261,9 @@ def treat_flag_at_cli(arguments):
 
             except IndexError :
                 i+=1 #the reach the end of arguments
-                try :
-                    options['doppler_picture'] = int(decal)
-                    options['shift'] = [-int(decal), 0, int(decal)]
-                except ValueError :
-                    print('ERROR : Generating doppler picture need one integer')
-                    print(usage())
-                    sys.exit()
-
-            except:
+            try :
+                options['doppler_picture'] = int(decal) # -n and n are added to the pixel shifts
+            except ValueError :
                 print('ERROR : Generating doppler picture need one integer')
                 print(usage())
                 sys.exit()
@@ -242,14 +319,14 @@ def interpret_UI_values(ui_values):
     options['clahe_only'] = ui_values['-CLAHE_ONLY-']
     options['crop_width_square'] = ui_values['-crop_width_square-']
     options['doppler_picture'] = int(ui_values['-dopplergram-'])
-    if options['doppler_picture'] > 0:
-        decal = options['doppler_picture']
-        options['shift'] = [-int(decal), 0, int(decal)]
 
     options['transversalium'] = ui_values['-transversalium-']
     options['trans_strength'] = int(ui_values['-trans_strength-']*100) + 1
     options['flip_x'] = ui_values['-flip_x-']
     options['img_rotate'] = int(ui_values['img_rotate'])
+    options['stack'] = None if ui_values['-stack-'] == 'none' else ui_values['-stack-']
+    options['mosaic'] = ui_values['-mosaic-']
+    options['quick_look'] = sol.QUICK_LOOK_STEP if ui_values['-quick_look-'] else 0
     global serfiles
     serfiles=ui_values['-FILE-'].split(';')
     try:
@@ -296,41 +373,142 @@ def inputUI():
     [sg.Text('Protus adjustment', size=(25,1)), sg.Input(default_text=str(options['delta_radius']), size=(8,1), tooltip = 'make the black circle bigger or smaller by inputting an integer', key='-delta_radius-')],
 
     [sg.Text('Dopplergram with shift \n(0 for none): ', size=(25,2)), sg.Input(default_text=0, size=(8,1),key='-dopplergram-')],
+    [sg.Text('Stack the files', size=(25,1)), sg.Combo(('none',) + stack_scans.STACK_METHODS, default_value=options['stack'] or 'none', size=(8,1), readonly=True, key='-stack-')],
+    [sg.Checkbox('Partial scans: assemble a mosaic', default=options['mosaic'], key='-mosaic-')],
+    [sg.Checkbox('Quick look only (small preview png)', default=options['quick_look'] > 0, key='-quick_look-')],
+    [sg.ProgressBar(1000, orientation='h', size=(50, 15), key='-PROGRESS-')],
+    [sg.Text('', size=(90, 1), key='-STATUS-')],
     [sg.Button('OK'), sg.Cancel()]
     ] 
     
     window = sg.Window('Processing', layout, finalize=True)
     window.BringToFront()
-    
+    batch = None # background processing of the files
     
     while True:
-        event, values = window.read()
-        if event==sg.WIN_CLOSED or event=='Cancel':
+        event, values = window.read(timeout=100)
+        if event==sg.WIN_CLOSED or event=='Cancel' and batch is None:
+            if batch is not None:
+                batch.stop() # the manifest records the file as cancelled
             window.close()
             sys.exit()
-        
-        if event=='OK':
+
+        if event=='Cancel': # stop the processing, the window stays open
+            batch.cancel()
+            window['-STATUS-'].update('Cancelling ...')
+
+        if event=='OK' and batch is None:
             if not values['-FILE-'] == options['workDir'] and not values['-FILE-'] == '':
                 try:
                     interpret_UI_values(values)
-                    window.close()
-                    return
+                    options['workDir'] = os.path.dirname(serfiles[-1])
+                    write_ini() # save parameters to .ini file
+                    batch = BackgroundBatch(serfiles, options)
+                    window['OK'].update(disabled=True)
+                    window['-PROGRESS-'].update(0)
                 except Exception as inst:
                     sg.Popup('Error: ' + inst.args[0], keep_on_top=True)
                     
             else:
                 # display pop-up file not entered
                 sg.Popup('Error: file not entered! Please enter file(s)', keep_on_top=True)
-        window.Element('-trans_strength-').Update(visible = values['-transversalium-'])
-        window.Element('text_trans').Update(visible = values['-transversalium-'])    
+
+        if batch is not None:
+            running = batch.poll()
+            window['-PROGRESS-'].update(int(1000 * batch.fraction()))
+            window['-STATUS-'].update(batch.status_text())
+            if not running:
+                batch = None
+                window['OK'].update(disabled=False)
+        if event != sg.TIMEOUT_KEY:
+            window.Element('-trans_strength-').Update(visible = values['-transversalium-'])
+            window.Element('text_trans').Update(visible = values['-transversalium-'])    
 
     
 
+def run_batch(serfiles, options, messages, cancel):
+    """background process of the GUI: process the files, send the progress messages to the GUI"""
+    try:
+        do_work(serfiles, options, progress=lambda *message: messages.put(message), cancel=cancel)
+    finally:
+        messages.put(('end',))
+
+
+class BackgroundBatch:
+    """files processed by do_work in another process, so that the GUI stays responsive"""
+
+    def __init__(self, serfiles, options):
+        context = multiprocessing.get_context('spawn') # no Tk state inherited from the GUI
+        self.messages = context.Queue()
+        self.cancel_event = context.Event()
+        self.n_files = len(serfiles)
+        self.index, self.name, self.frames, self.total, self.fps = 0, '', 0, 0, 0.0
+        self.statuses = []
+        self.process = context.Process(target=run_batch, args=(list(serfiles), options.copy(), self.messages, self.cancel_event), daemon=True)
+        self.process.start()
+
+    def cancel(self):
+        """stop after the current frame, the manifest marks the file as cancelled"""
+        self.cancel_event.set()
+
+    def stop(self, timeout=BATCH_STOP_TIMEOUT):
+        """cancel and wait for the end of the process, killed after timeout seconds"""
+        self.cancel()
+        deadline = time.time() + timeout
+        while self.poll() and time.time() < deadline: # the queue is read, or the process could not end
+            self.process.join(0.1)
+        if self.process.is_alive():
+            print('WARNING: the processing did not stop, killed')
+            self.process.terminate()
+            self.process.join()
+
+    def poll(self):
+        """read the progress messages, OUT : False once the batch is finished"""
+        alive = self.process.is_alive() # before reading: the messages of a finished process are all queued
+        while True:
+            try:
+                message = self.messages.get_nowait()
+            except queue.Empty:
+                break
+            if message[0] == 'file':
+                self.index, self.n_files, self.name = message[1], message[2], os.path.basename(message[3])
+                self.frames, self.total, self.fps = 0, 0, 0.0
+            elif message[0] == 'frames':
+                self.frames, self.total, self.fps = message[1:]
+            elif message[0] == 'status':
+                self.statuses.append(message[2])
+            elif message[0] == 'end':
+                self.process.join()
+                return False
+        if not alive: # killed without its last message
+            self.statuses.append('failed')
+            return False
+        return True
+
+    def fraction(self):
+        """fraction of the batch done"""
+        done = len(self.statuses) + (self.frames / self.total if self.total else 0)
+        return min(1.0, done / max(1, self.n_files))
+
+    def status_text(self):
+        if len(self.statuses) == self.n_files or not self.process.is_alive():
+            return 'Finished : ' + ', '.join(str(self.statuses.count(s)) + ' ' + s for s in sorted(set(self.statuses)))
+        if self.cancel_event.is_set():
+            return 'Cancelling ...'
+        text = 'File ' + str(self.index + 1) + '/' + str(self.n_files) + ' ' + self.name
+        if self.total:
+            text += f' : frame {self.frames}/{self.total}'
+        if self.fps > 0:
+            text += f', {self.fps:.0f} frames/s, ETA {(self.total - self.frames) / self.fps:.0f} s'
+        return text
+
+
 '''
 open SHG.ini and read parameters
 return parameters from file, or default if file not found or invalid
+keys : options read from the file (None for all of them)
 '''
-def read_ini():
+def read_ini(keys=None):
     # check for .ini file for working directory
     print('loading config file...')
 
@@ -339,7 +517,9 @@ def read_ini():
         with open(mydir_ini, 'r') as fp:
             global options
             options_ = json.load(fp)
-            options.update(options)
+            options.update(options_ if keys is None else {key: options_[key] for key in keys if key in options_})
+    except FileNotFoundError:
+        print('note: no config file - using default parameters')
     except Exception:
         traceback.print_exc()
         print('note: error reading config file - using default parameters')
@@ -355,46 +535,140 @@ def write_ini():
         traceback.print_exc()
         print('ERROR: failed to write config file: ' + mydir_ini)
 
-def do_work(serfiles, options, cli = False):
+def do_work(serfiles, options, cli = False, progress = None, cancel = None, profile = None):
+    """
+    process the files, profiled if profile is the number of functions of the printed table (see profiling)
+    progress, if given, is called with ('file', index, number of files, file) when a file starts,
+    ('frames', frames read, frames to read, frames per second) during its reconstruction
+    and ('status', index, status) when it ends; the batch stops when the event cancel is set
+    """
     print('Processing')
     if len(serfiles)==1:
         options['tempo']=60000 #4000 #pour gerer la tempo des affichages des images resultats dans cv2.waitKey
     else:
         options['tempo']=5000
-        
-    # boucle sur la liste des fichers
-    for serfile in serfiles:
-        if serfile=='':
-            print("ERROR filename empty")
-            return
-        print('file %s is processing'%serfile)
-        options['workDir'] = os.path.dirname(serfile)
-        try :
-            os.chdir(options['workDir'])
-        except :
-            os.chdir('.')
-        base = os.path.basename(serfile)
-        basefich = os.path.splitext(base)[0]
-        if base == '':
-            print('filename ERROR : ',serfile)
-            return
 
-        # ouverture du fichier ser
-        try:
-            f=open(serfile, "rb")
-            f.close()
-        except:
-            print('ERROR opening file : ',serfile)
+    # frame rate of the file being reconstructed, the cancel event is checked after each frame
+    rate = {}
+    def frame_progress(done, total):
+        if cancel is not None and cancel.is_set():
+            raise sol.ProcessingCancelled('cancelled')
+        now = time.time()
+        if not rate:
+            rate.update(start=now, first=done, last=0)
+        if progress is not None and (done == total or now - rate['last'] > 0.2):
+            rate['last'] = now
+            progress('frames', int(done), int(total), (done - rate['first']) / max(now - rate['start'], 1e-3))
+    sol.set_progress_callback(frame_progress)
+    try:
+        if options['quick_look'] > 0: # previews only: no manifest, stack or mosaic
+            for k, serfile in enumerate(serfiles):
+                if cancel is not None and cancel.is_set():
+                    break
+                if progress is not None:
+                    progress('file', k, len(serfiles), serfile)
+                rate.clear()
+                start = time.time()
+                try:
+                    with profiling.profile_file(serfile, profile):
+                        sol.quick_look(serfile, options.copy())
+                    print('quick look of %s in %.2f s' % (serfile, time.time() - start))
+                    status = 'done'
+                except sol.ProcessingCancelled:
+                    print('quick look cancelled : ' + serfile)
+                    status = 'cancelled'
+                except:
+                    print('ERROR ENCOUNTERED')
+                    traceback.print_exc()
+                    status = 'failed'
+                if progress is not None:
+                    progress('status', k, status)
             return
 
-        # save parameters to .ini file
-        write_ini()
-        try : 
-            sol.solex_proc(serfile,options.copy()) 
+        # images of all the files combined at the end: mosaic or stack
+        stacker = None
+        if options['mosaic']:
+            stacker = mosaic.Mosaic(serfiles[0])
+        elif options['stack'] and len(serfiles) > 1:
+            stacker = stack_scans.Stacker(serfiles[0], len(serfiles), options['stack'])
+
+        # boucle sur la liste des fichers
+        status = None
+        for k, serfile in enumerate(serfiles):
+            if cancel is not None and cancel.is_set():
+                break
+            if progress is not None:
+                progress('file', k, len(serfiles), serfile)
+            rate.clear()
+            if serfile=='':
+                print("ERROR filename empty")
+                return
+            print('file %s is processing'%serfile)
+            options['workDir'] = os.path.dirname(serfile)
+            try :
+                os.chdir(options['workDir'])
+            except :
+                os.chdir('.')
+            base = os.path.basename(serfile)
+            basefich = os.path.splitext(base)[0]
+            if base == '':
+                print('filename ERROR : ',serfile)
+                return
+
+            # ouverture du fichier ser
+            try:
+                f=open(serfile, "rb")
+                f.close()
+            except:
+                print('ERROR opening file : ',serfile)
+                return
+
+            manifest = batch_manifest.Manifest(os.path.dirname(os.path.abspath(serfile)))
+            fingerprint = batch_manifest.file_fingerprint(serfile)
+            opt_hash = batch_manifest.options_hash(options)
+            if options['resume'] and stacker is None and manifest.is_done(base, fingerprint, opt_hash):
+                print('already processed with the same options, skipped : ' + serfile)
+                if progress is not None:
+                    progress('status', k, 'skipped')
+                continue
+            manifest.mark(base, 'running', fingerprint, opt_hash)
+            start = time.time()
+            try : 
+                with profiling.profile_file(serfile, profile):
+                    results = sol.solex_proc(serfile, stacker.scan_options(options) if stacker is not None else options.copy())
+                if stacker is not None:
+                    stacker.add(results)
+                manifest.mark(base, 'done', outputs=batch_manifest.list_outputs(serfile, start))
+                status = 'done'
+            except sol.ProcessingCancelled:
+                print('PROCESSING CANCELLED : ' + serfile)
+                manifest.mark(base, 'cancelled')
+                status = 'cancelled'
+                if options['flag_display']:
+                    cv2.destroyAllWindows()
+                if progress is not None:
+                    progress('status', k, 'cancelled')
+                break
+            except:
+                print('ERROR ENCOUNTERED')
+                traceback.print_exc()
+                manifest.mark(base, 'failed', error=traceback.format_exc().strip().split('\n')[-1])
+                cv2.destroyAllWindows()
+                status = 'failed'
+            if progress is not None:
+                progress('status', k, status)
+    finally:
+        sol.set_progress_callback(None) # also after the early returns and errors
+
+    if stacker is not None and (status == 'cancelled' or cancel is not None and cancel.is_set()):
+        stacker.discard() # the files combined would be incomplete
+        stacker = None
+    if stacker is not None:
+        try:
+            stacker.finish(options)
         except:
-            print('ERROR ENCOUNTERED')
+            print('ERROR ENCOUNTERED WHILE COMBINING THE FILES')
             traceback.print_exc()
-            cv2.destroyAllWindows()
 
 """
 -------------------------------------------------------------------------------------------
@@ -405,27 +679,45 @@ if __name__ == '__main__':
     # check for CLI input
 
     if len(sys.argv)>1:
-        for argument in sys.argv[1:]:
-            if '-' == argument[0]: #it's flag options
+        read_ini(CONFIG_FILE_OPTIONS) # the GUI parameters of the file are ignored
+        arguments = iter(sys.argv[1:])
+        for argument in arguments:
+            if argument.startswith('--frames'): # --frames a:b or --frames=a:b
+                try:
+                    frames = argument.split('=')[1] if '=' in argument else next(arguments)
+                    options['frames'] = [int(x) for x in frames.split(':')]
+                    assert len(options['frames']) == 2
+                except (StopIteration, ValueError, AssertionError):
+                    print('ERROR : invalid frame range, use --frames first:last')
+                    print(usage())
+                    sys.exit()
+            elif argument.startswith('--profile'): # --profile or --profile=n
+                try:
+                    profile_top = int(argument.split('=')[1]) if '=' in argument else profiling.DEFAULT_TOP
+                except ValueError:
+                    print('ERROR : invalid number of functions, use --profile=n')
+                    print(usage())
+                    sys.exit()
+            elif '-' == argument[0]: #it's flag options
                 treat_flag_at_cli(argument)
+            elif os.path.isdir(argument): #it's a directory to watch
+                watch_dirs.append(os.path.abspath(argument))
             else : #it's a file or some files
                 if argument.split('.')[-1].upper()=='SER' or argument.split('.')[-1].upper()=='AVI': 
                     dirname = os.path.dirname(os.path.abspath(argument))
                     serfiles.append(os.path.join(dirname,argument))
         print('theses files are going to be processed : ', serfiles)
 
-    if 0: #test code for performance test
-        inputUI()
-        cProfile.run('do_work(serfiles, options)', sort='cumtime')
+    if server_port is not None:
+        solex_server.serve(options, workers, server_port) # processing service
+    elif len(watch_dirs) > 0:
+        watch_folder.watch(watch_dirs, options, workers) # daemon mode
+    # if no command line arguments, open GUI interface
+    elif len(serfiles)==0:
+        # read initial parameters from .ini file
+        read_ini()
+        inputUI() # the files are processed in the background, the window stays open
     else:
-        # if no command line arguments, open GUI interface
-        if len(serfiles)==0:
-            # read initial parameters from .ini file
-            read_ini()
-            while True:
-                inputUI()
-                do_work(serfiles, options)
-        else:
-            do_work(serfiles, options) # use inputs from CLI
+        do_work(serfiles, options, profile=profile_top) # use inputs from CLI
 
 
@@ -12,21 +12,100 @@ Reconstruction of an image from the deviations between the minimum of the line a
 
 from solex_util import *
 from video_reader import *
-from ellipse_to_circle import ellipse_to_circle, correct_image
-import json
+from ellipse_to_circle import ellipse_to_circle, correct_image, circle_with_geometry, fit_tilt
+from session_geometry import SessionGeometry, MAX_AXIS_RATIO
+from camera_db import find_camera, camera_binning, camera_header
 import numpy as np
 import cv2
 
+QUICK_LOOK_FIT_FRAMES = 32 # frames sampled for the spectral line detection of a quick look
+QUICK_LOOK_STEP = 4 # default frame step and row binning of a quick look
+
+
+def scan_speed_ratio(rdr, camera, binning, options):
+    """Y/X ratio expected from the scan speed, the frame interval and the pixel scale, None if unknown"""
+    if not (options['scan_speed'] and options['focal_length'] and binning is not None and camera['pixel_size'] and rdr.frame_interval()):
+        return None
+    pixel_scale = 206.265 * camera['pixel_size'] * binning / options['focal_length'] # arcsec per pixel
+    ratio = options['scan_speed'] * rdr.frame_interval() / pixel_scale
+    logme('Frame interval : ' + "{:.5f}".format(rdr.frame_interval()) + ' s, expected Y/X ratio : ' + "{:.3f}".format(ratio))
+    return ratio
+
+
+def quick_look(file_, options):
+    """
+    quick look at a file before the full processing: shift 0 disk reconstructed from one frame
+    in every options['quick_look'] frames, rows binned by the same factor (so the Y/X ratio is
+    unchanged), no ellipse fit: the geometry is the given one, the one of the session or the one
+    expected from the scan speed (Y/X ratio 1, no tilt if none is known)
+    IN : file path, options dictionary (see SHG_MAIN)
+    OUT : 8-bit clahe image, written to file_quicklook.png if options['write_files'] is True
+    """
+    clearlog()
+    k = options['quick_look']
+    quick = dict(options, shift=[0], line_fit_frames=QUICK_LOOK_FIT_FRAMES, write_files=False, save_fit=False, flag_display=False,
+                 line_drift=0, velocity_map=0, checkpoint_frames=0)
+    quick['frame_range'] = options['frames'] if options['frames'] is not None else find_scan_extent(file_, options['colour_channel']) if options['trim_frames'] else None
+    rdr = video_reader(file_, quick['frame_range'], options['colour_channel'])
+    fit = compute_mean_return_fit(file_, quick, make_header(rdr), rdr.iw, rdr.ih, '')[0]
+    disk = read_video_improved(file_, fit, quick)[0][0]
+    disk = disk[:disk.shape[0] // k * k].reshape(-1, k, disk.shape[1]).mean(axis=1, dtype=options['precision'])
+    if options['flip_x']:
+        disk = np.flip(disk, axis = 1)
+
+    ratio, slant = options['ratio_fixe'], options['slant_fix']
+    if ratio is None and slant is None:
+        geometry = SessionGeometry(os.path.dirname(os.path.abspath(file_))).geometry(file_, (rdr.iw, rdr.ih), 1)
+        if geometry is None:
+            camera = find_camera(rdr.Observer, rdr.Telescope, rdr.Instrument)
+            binning = camera_binning(camera, rdr.Width // rdr.channel_bin) if camera is not None else None
+            geometry = (scan_speed_ratio(rdr, camera, binning, options), 0.0)
+        ratio, slant = geometry
+    ratio = ratio if ratio is not None else 1.0
+    slant = slant if slant is not None else 0.0
+    logme('Quick look : 1 frame in ' + str(k) + ', Y/X ratio ' + "{:.3f}".format(ratio) + ', tilt angle ' + "{:.3f}".format(slant) + ' degrees')
+    frame = correct_image(disk / 65536, math.radians(slant), ratio, np.array([-1.0, -1.0]), -1.0)[0]
+
+    cl1 = cv2.createCLAHE(clipLimit=0.8, tileGridSize=(2,2)).apply(frame)
+    cc = return_frame_contrasted(cl1, 'clahe', options['precision'])[0]
+    cc = np.rot90(cc, options['img_rotate']//90, axes=(0,1))
+    cc = (cc >> 8).astype('uint8')
+    if options['write_files']:
+        cv2.imwrite(os.path.splitext(file_)[0] + '_quicklook.png', cc)
+    return cc
+
 
 def solex_proc(file_, options):
+    """
+    process one SER/AVI file
+    IN : file path, options dictionary (see SHG_MAIN)
+    files are written next to the video file if options['write_files'] is True
+    OUT : dictionary with
+    'shifts' : {shift: {'raw', 'circular', 'detransversaliumed', 'disk', 'diskHC', 'protus', 'clahe'}}
+    arrays for every user shift, filled only if options['keep_arrays'] is True
+    'header' : fits header, 'circle' : (centre x, centre y, radius) or (-1, -1, -1)
+    'ratio', 'slant' : Y/X ratio and tilt angle (degrees) used, 'borders' : [minX, minY, maxX, maxY]
+    'dopplergrams' : {(negative shift, positive shift): RGB dopplergram} (if requested and options['keep_arrays'])
+    'line_centre' : line centre offset from the line fit, in pixels (if options['velocity_map'] and options['keep_arrays'])
+    'log' : list of log lines
+    """
     clearlog()
+    if options['doppler_picture'] > 0: # make sure both shifts of the dopplergram are processed
+        options['shift'] = options['shift'] + [s for s in (-options['doppler_picture'], options['doppler_picture']) if s not in options['shift']]
     logme('Pixel shift : ' + str(options['shift']))
+    pairs = doppler_pairs(options['shift'], options)
+    doppler_shifts = set(s for pair in pairs for s in pair)
     options['shift'] = [10, 0] + options['shift']  # 10, 0 are "fake"
-    WorkDir = os.path.dirname(file_) + "/"
-    os.chdir(WorkDir)
+    WorkDir = os.path.dirname(os.path.abspath(file_))
     base = os.path.basename(file_)
-    basefich0 = os.path.splitext(base)[0]
-    rdr = video_reader(file_)
+    basefich0 = os.path.join(WorkDir, os.path.splitext(base)[0])
+    # frames processed: given by the user, or the frames where the Sun crosses the slit
+    options['frame_range'] = options['frames'] if options['frames'] is not None else find_scan_extent(file_, options['colour_channel']) if options['trim_frames'] else None
+    rdr = video_reader(file_, options['frame_range'], options['colour_channel'])
+    if rdr.bayer is not None or rdr.planes == 3:
+        logme('Colour file, channel used : ' + options['colour_channel'] + (', 2x2 binned Bayer matrix ' + rdr.bayer if rdr.bayer is not None else ''))
+    if options['frame_range'] is not None:
+        logme('Frames processed : ' + str(rdr.first_frame) + ' to ' + str(rdr.first_frame + rdr.FrameCount - 1))
     hdr = make_header(rdr)
     ih = rdr.ih
     iw = rdr.iw
@@ -34,25 +113,24 @@ def solex_proc(file_, options):
     fit, backup_y1, backup_y2 = compute_mean_return_fit(file_, options, hdr, iw, ih, basefich0)
 
     ####adding binning information###
-    absFilePath = os.path.abspath(__file__)
-    path, filename = os.path.split(absFilePath)
-    with open(os.path.join(path, 'camera_list.json')) as json_file:
-            cameras = json.load(json_file)
-            bin_text = '0'
-            for key in cameras.keys():
-                if key in rdr.Observer or key in rdr.Telescope or key in rdr.Instrument :
-                    logme(f'CAMERA INFORMATIONS FOUND, your camera is a {key}')
-                    bin_text = '_bin'+str(round(int(cameras[key])//rdr.Width,0))
-                    break
-            if bin_text == '0':
-                logme('WARNING : camera information not found. If width is <2000, bin2 is guessed')
-                if rdr.Width <2000 :
-                    bin_text = '_bin2'
-                else :
-                    bin_text = '_bin1'
+    camera = find_camera(rdr.Observer, rdr.Telescope, rdr.Instrument)
+    if camera is not None:
+        logme(f'CAMERA INFORMATIONS FOUND, your camera is a {camera["name"]}')
+        binning = camera_binning(camera, rdr.Width // rdr.channel_bin)
+        camera_header(hdr, camera, binning)
+        bin_text = '_bin' + str(binning)
+    else:
+        binning = None
+        logme('WARNING : camera information not found. If width is <2000, bin2 is guessed')
+        if rdr.Width <2000 :
+            bin_text = '_bin2'
+        else :
+            bin_text = '_bin1'
     basefich0+=bin_text
 
-    disk_list, ih, iw, FrameCount = read_video_improved(file_, fit, options)
+    apriori_ratio = scan_speed_ratio(rdr, camera, binning, options)
+
+    disk_list, ih, iw, FrameCount, line_centre = read_video_improved(file_, fit, options)
 
     hdr['NAXIS1'] = iw  # note: slightly dodgy, new width
 
@@ -70,8 +148,8 @@ def solex_proc(file_, options):
     logme(f'Protus adjustment : {options["delta_radius"]}')
     borders = [0,0,0,0]
     cercle0 = (-1, -1, -1)
-    frames_circularized = []
-    doppler_list=[]
+    results = {'shifts': {}, 'header': hdr}
+    doppler_images = {}
 
     #DOC : disk_list[0] is shift=10, disk_list[1] is shift=0. if existing other shifts are after.
     for i in range(len(disk_list)):
@@ -79,7 +157,8 @@ def solex_proc(file_, options):
         if options['flip_x']:
             disk_list[i] = np.flip(disk_list[i], axis = 1)
         basefich = basefich0 + '_shift=' + str(options['shift'][i])
-        if options['save_fit'] and i >= 2:
+        save_fit = options['save_fit'] and options['write_files'] and i >= 2
+        if save_fit:
             DiskHDU = fits.PrimaryHDU(disk_list[i], header=hdr)
             DiskHDU.writeto(basefich + '_raw.fits', overwrite='True')
 
@@ -89,17 +168,36 @@ def solex_proc(file_, options):
         """
         # disk_list[0] is always shift = 10, for more contrast for ellipse fit
         if options['ratio_fixe'] is None and options['slant_fix'] is None:
-            frame_circularized, cercle0, options['ratio_fixe'], phi, borders = ellipse_to_circle(
-                disk_list[i], options, basefich)
-            # in options angles are stored as degrees (slightly annoyingly)
-            options['slant_fix'] = math.degrees(phi)
+            session, geometry = None, None
+            if options['session_geometry'] > 0:
+                session = SessionGeometry(WorkDir)
+                geometry = session.geometry(file_, (rdr.iw, rdr.ih), options['session_geometry'])
+            if geometry is None and apriori_ratio is not None:
+                geometry = (apriori_ratio, math.degrees(fit_tilt(disk_list[i], apriori_ratio))) # ratio from the scan speed, tilt fitted with it
+            if geometry is not None:
+                # geometry of the previous files of the session or from the scan speed, only checked on the corrected disk
+                frame_circularized, cercle0, borders, axis_ratio = circle_with_geometry(disk_list[i], options, geometry[0], math.radians(geometry[1]))
+                if axis_ratio < MAX_AXIS_RATIO:
+                    logme('Known geometry used, no ellipse fit')
+                    options['ratio_fixe'], options['slant_fix'] = geometry
+                    phi = math.radians(options['slant_fix'])
+                else:
+                    logme('WARNING : known geometry rejected, fitting an ellipse')
+                    geometry = None
+            if geometry is None:
+                frame_circularized, cercle0, options['ratio_fixe'], phi, borders = ellipse_to_circle(
+                    disk_list[i], options, basefich)
+                # in options angles are stored as degrees (slightly annoyingly)
+                options['slant_fix'] = math.degrees(phi)
+                if session is not None:
+                    session.add(file_, (rdr.iw, rdr.ih), options['ratio_fixe'], options['slant_fix'])
 
         else:
-            ratio = options['ratio_fixe'] if not options['ratio_fixe'] is None else 1.0
+            ratio = options['ratio_fixe'] if not options['ratio_fixe'] is None else apriori_ratio if apriori_ratio is not None else 1.0
             phi = math.radians(options['slant_fix']) if not options['slant_fix'] is None else 0.0
-            frame_circularized = correct_image(disk_list[i] / 65536, phi, ratio, np.array([-1.0, -1.0]), -1.0, print_log=i == 0)[0]  # Note that we assume 16-bit
+            frame_circularized = correct_image(np.divide(disk_list[i], 65536, dtype=options['precision']), phi, ratio, np.array([-1.0, -1.0]), -1.0, print_log=i == 0)[0]  # Note that we assume 16-bit
 
-        if options['save_fit'] and i >= 2:  # first two shifts are not user specified
+        if save_fit:  # first two shifts are not user specified
             DiskHDU = fits.PrimaryHDU(frame_circularized, header=hdr)
             DiskHDU.writeto(basefich + '_circular.fits', overwrite='True')
 
@@ -111,71 +209,39 @@ def solex_proc(file_, options):
         else:
             detransversaliumed = frame_circularized
 
-        if options['save_fit'] and i >= 2 and options['transversalium']:  # first two shifts are not user specified
+        if save_fit and options['transversalium']:  # first two shifts are not user specified
             DiskHDU = fits.PrimaryHDU(detransversaliumed, header=hdr)
             DiskHDU.writeto(basefich + '_detransversaliumed.fits', overwrite='True')
 
-        cercle = cercle0
-        if options['fixed_width'] is not None or options['crop_width_square']:
-            h, w = detransversaliumed.shape
-
-            nw = h if options['fixed_width'] is None else options['fixed_width'] # new width
-            nh=h
-            if options['crop_width_square']:
-                nh= nw
-
-            nw2 = nw // 2
-            cx = w // 2 if cercle == (-1, -1, -1) else int(cercle[0])
-            tx = nw2 - cx
-
-            new_img = np.full((nh, nw), detransversaliumed[0, 0], dtype=detransversaliumed.dtype)
-            new_img[:, :min(cx + nw2, detransversaliumed.shape[1]) - max(0, cx - nw2)] = detransversaliumed[(h-nh)//2:(h+nh)//2, max(0, cx - nw2) : min(cx + nw2, detransversaliumed.shape[1])]
-
-            if tx > 0:
-                new_img = np.roll(new_img, tx, axis = 1)
-                new_img[:, :tx] = detransversaliumed[0, 0]
-
-            if not cercle == (-1, -1, -1):
-                cercle = (nw2, nh//2, cercle[2])
-            detransversaliumed = new_img
+        detransversaliumed, cercle = crop_width(detransversaliumed, cercle0, options)
 
         if i >= 2: #other shifts, if existing
-            image_process(detransversaliumed, cercle, options, hdr, basefich)
-            if options['doppler_picture']>0 :
-                doppler_list.append(detransversaliumed)
-
-    if isinstance(options['doppler_picture'],int) and options['doppler_picture']>0:
-        basefich = f"{basefich0}_shift={options['doppler_picture']}_DOPPLERGRAM"
-        if not options['clahe_only'] :
-            DiskHDU1 = fits.PrimaryHDU(disk_list[0], header=hdr)
-            DiskHDU1.writeto(basefich + '_neg.fits', overwrite='True')
-
-            #DiskHDU2 = fits.PrimaryHDU((disk_list[0]+disk_list[2])/2, header=hdr)
-            DiskHDU2 = fits.PrimaryHDU((disk_list[0]+disk_list[2])/2, header=hdr)
-            DiskHDU2.writeto(basefich + '_mean.fits', overwrite='True')
-
-            DiskHDU3 = fits.PrimaryHDU(disk_list[2], header=hdr)
-            DiskHDU3.writeto(basefich + '_pos.fits', overwrite='True')
-
-        #######DOPPLERGRAM########
-        frame1, frame2 = doppler_list[0],doppler_list[2]
-        # mean picture creation
-        img_doppler=np.zeros([ih, frame1.shape[1], 3],dtype='uint16')
-        mean=np.array(((frame1+frame2)/2), dtype='uint16')
-
-        #compute contrast on mean picture
-        picture_mean,sb,sh=return_frame_contrasted(mean, 'strong')
-
-        #apply the same constast on pictures
-        picture_3=apply_contrast(frame2,sb,sh)
-        picture_1=apply_contrast(frame1,sb,sh)
-
-        img_doppler[:,:,0] = picture_1
-        img_doppler[:,:,1] = picture_mean
-        img_doppler[:,:,2] = picture_3
-        cv2.imwrite(basefich+'.png',img_doppler)
-
-    with open(basefich0 + '_log.txt', "w") as logfile:
-        logfile.writelines(mylog)
-
-    return frames_circularized[2:], hdr, cercle
+            processed = image_process(detransversaliumed, cercle, options, hdr, basefich)
+            if options['keep_arrays']:
+                results['shifts'][options['shift'][i]] = dict(processed, raw=disk_list[i], circular=frame_circularized, detransversaliumed=detransversaliumed)
+            if options['shift'][i] in doppler_shifts:
+                doppler_images[options['shift'][i]] = detransversaliumed
+
+    if len(pairs) > 0:
+        dopplergrams = make_dopplergrams(doppler_images, pairs, options, hdr, basefich0)
+        if options['keep_arrays']:
+            results['dopplergrams'] = dopplergrams
+
+    if line_centre is not None:
+        # same geometry as the disks, but no transversalium correction: the map holds positions, not intensities
+        if options['flip_x']:
+            line_centre = np.flip(line_centre, axis = 1)
+        line_centre = correct_image(np.divide(line_centre, 65536, dtype=options['precision']), phi, options['ratio_fixe'] if not options['ratio_fixe'] is None else ratio, np.array([-1.0, -1.0]), -1.0)[0]
+        line_centre, _ = crop_width(line_centre, cercle0, options)
+        line_centre_map = make_line_centre_map(line_centre, cercle, options, hdr, basefich0)
+        if options['keep_arrays']:
+            results['line_centre'] = line_centre_map
+
+    if options['write_files']:
+        with open(basefich0 + '_log.txt', "w") as logfile:
+            logfile.writelines(mylog)
+    if options['checkpoint_frames'] > 0:
+        remove_checkpoint(file_)
+
+    results.update(circle=cercle, ratio=options['ratio_fixe'], slant=options['slant_fix'], borders=borders, log=list(mylog))
+    return results
@@ -0,0 +1,95 @@
+"""
+Version 19 October 2026
+
+------------------------------------------------------------------------
+Batch manifest: a JSON file in the directory of the video files recording, for each
+file, its fingerprint (size, date and a hash of its first and last MB), a hash of the
+processing options, the status (running, done, failed, cancelled) and the files produced.
+A batch run with the resume option skips the files already done with the same
+options and processes again the ones that failed or were interrupted.
+------------------------------------------------------------------------
+
+"""
+import os
+import json
+import time
+import hashlib
+import traceback
+
+MANIFEST_FILE = 'SHG_manifest.json'
+
+# options that do not change the output files
+IGNORED_OPTIONS = ('workDir', 'tempo', 'flag_display', 'keep_arrays', 'resume', 'checkpoint_frames')
+
+# files named after the first video file of a batch that are not its outputs: checkpoint,
+# stack and mosaic of the batch, profiles
+DERIVED_PRODUCTS = ('checkpoint', 'stack', 'mosaic', 'profile')
+
+
+def file_fingerprint(file_):
+    """size, modification date and hash of the first and last MB of a file"""
+    st = os.stat(file_)
+    h = hashlib.sha1()
+    with open(file_, 'rb') as f:
+        h.update(f.read(2**20))
+        f.seek(max(0, st.st_size - 2**20))
+        h.update(f.read(2**20))
+    return {'size': st.st_size, 'mtime': st.st_mtime, 'hash': h.hexdigest()}
+
+
+def options_hash(options):
+    opts = {k: v for k, v in options.items() if k not in IGNORED_OPTIONS}
+    return hashlib.sha1(json.dumps(opts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def list_outputs(file_, start):
+    """files written next to file_ (base name followed by _) since time start"""
+    directory = os.path.dirname(os.path.abspath(file_))
+    prefix = os.path.splitext(os.path.basename(file_))[0] + '_'
+    names = os.listdir(directory)
+    videos = [f for f in names if f.upper().endswith(('.SER', '.AVI'))]
+    # not the products of the batch, nor the outputs of the video files named like prefix_xxx
+    excluded = tuple(prefix + d for d in DERIVED_PRODUCTS) + tuple(os.path.splitext(f)[0] + '_' for f in videos if f.startswith(prefix))
+    return sorted(os.path.join(directory, f) for f in names
+                  if f.startswith(prefix) and not f.startswith(excluded) and f not in videos
+                  and os.path.getmtime(os.path.join(directory, f)) >= start - 1)
+
+
+class Manifest:
+    """manifest of the video files of one directory"""
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, MANIFEST_FILE)
+        try:
+            with open(self.path, 'r') as fp:
+                self.entries = json.load(fp)
+        except FileNotFoundError:
+            self.entries = {}
+        except Exception:
+            traceback.print_exc()
+            print('WARNING: unreadable manifest ' + self.path + ', starting a new one')
+            self.entries = {}
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as fp:
+            json.dump(self.entries, fp, sort_keys=True, indent=4)
+        os.replace(self.path + '.tmp', self.path) # never leave a half-written manifest
+
+    def is_done(self, name, fingerprint, opt_hash):
+        entry = self.entries.get(name)
+        return entry is not None and entry['status'] == 'done' and entry['fingerprint'] == fingerprint and entry['options'] == opt_hash
+
+    def mark(self, name, status, fingerprint=None, opt_hash=None, outputs=None, error=None):
+        entry = self.entries.setdefault(name, {})
+        entry['status'] = status
+        entry['time'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        if fingerprint is not None:
+            entry['fingerprint'] = fingerprint
+        if opt_hash is not None:
+            entry['options'] = opt_hash
+        if outputs is not None:
+            entry['outputs'] = outputs
+        entry.pop('error', None)
+        if error is not None:
+            entry['error'] = error
+        self.save()
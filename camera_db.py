@@ -0,0 +1,70 @@
+"""
+Version 19 October 2026
+
+------------------------------------------------------------------------
+Camera registry: camera_list.json is read once per process and indexed by normalized
+model name (upper case, letters and digits only), with for each camera the full sensor
+width and height (pixels), pixel size (microns), ADC bit depth, preferred read mode and
+other names of the model (aliases) found in the video headers.
+Entries of the older format (model name -> full width) are still accepted.
+------------------------------------------------------------------------
+
+"""
+import os
+import re
+import json
+import functools
+
+CAMERA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'camera_list.json')
+
+
+def normalize(name):
+    return re.sub('[^A-Z0-9]', '', name.upper())
+
+
+@functools.lru_cache(maxsize=None)
+def load_cameras(path=CAMERA_FILE):
+    """OUT : {normalized name: camera dictionary}"""
+    with open(path) as json_file:
+        cameras = json.load(json_file)
+    registry = {}
+    for name, info in cameras.items():
+        if not isinstance(info, dict):
+            info = {'width': int(info)}
+        camera = dict({'height': None, 'pixel_size': None, 'bit_depth': None, 'read_mode': None, 'aliases': []}, **info, name=name)
+        for key in [name] + camera['aliases']:
+            registry[normalize(key)] = camera
+    return registry
+
+
+@functools.lru_cache(maxsize=None)
+def find_camera(*texts):
+    """
+    IN : strings of the video header (observer, telescope, instrument)
+    OUT : camera dictionary, None if not found
+    an exact model name is preferred, then the longest model name found inside one of the strings
+    """
+    registry = load_cameras()
+    keys = [normalize(t) for t in texts]
+    for key in keys:
+        if key in registry:
+            return registry[key]
+    for name in sorted(registry, key=len, reverse=True):
+        if any(name in key for key in keys):
+            return registry[name]
+    return None
+
+
+def camera_binning(camera, width):
+    """binning guessed from the frame width and the full sensor width"""
+    return max(1, camera['width'] // int(width))
+
+
+def camera_header(hdr, camera, binning):
+    """add the camera information to a fits header"""
+    hdr['INSTRUME'] = camera['name']
+    hdr['BIN1'] = binning
+    hdr['BIN2'] = binning
+    if camera['pixel_size'] is not None:
+        hdr['XPIXSZ'] = camera['pixel_size'] * binning
+        hdr['YPIXSZ'] = camera['pixel_size'] * binning
@@ -23,11 +23,22 @@ from skimage.transform import downscale_local_mean
 import cv2
 
 import scipy
+from scipy.optimize import least_squares
 from ellipse import LsqEllipse
 from matplotlib.patches import Ellipse
 
 NUM_REG = 2  # 6 # include biggest NUM_REG regions in fit
              # for multiple full-disk scans this must be changed to 1
+             # (partial scans for a mosaic use more regions, see mosaic.py)
+COARSE_FACTOR = 8 # downscaling of the image for the coarse ellipse fit, refined at full resolution
+FALLBACK_FACTOR = 4 # downscaling of the coarse fit done again when the refined fit departs from the first one
+LIMB_ANGLES = 720 # at most one refined limb point in each of LIMB_ANGLES directions
+MIN_LIMB_POINTS = 20 # fewer refined limb points: the coarse fit is kept
+LIMB_CLIP_ITER = 5 # iterations of the outlier rejection of the refined limb points
+LIMB_TRIALS = 64 # random samples of LIMB_SAMPLE points tried to start the outlier rejection
+LIMB_SAMPLE = 8
+LIMB_MAX_CHANGE = 0.05 # refined fit rejected if its ratio, radius or centre (/ radius) moves further from the coarse fit
+CIRCLE_FACTOR = 4 # downscaling of the edge detection of circle_with_geometry
 
 
 def rot(x):
@@ -110,10 +121,8 @@ def correct_image(image, phi, ratio, center, height, print_log=False):
     my_transform = transform.ProjectiveTransform(matrix=mat3)
     corrected_img = transform.warp(image, my_transform, output_shape=(
         np.ceil(new_h), np.ceil(new_w)), cval=image[0, 0])
-    corrected_img = (
-        2**16 *
-        corrected_img).astype(
-        np.uint16)  # note : 16-bit output
+    corrected_img *= 2**16
+    corrected_img = corrected_img.astype(np.uint16)  # note : 16-bit output
     new_center = (np.linalg.inv(mat) @ center.T).T - \
         np.array([np.min(new_corners[:, 0]), np.min(new_corners[:, 1])])
     
@@ -141,41 +150,34 @@ def correct_image(image, phi, ratio, center, height, print_log=False):
     return corrected_img, (new_center[0], new_center[1], new_radius), mat3
 
 
-def get_flood_image(image):
+def get_flood_image(img_blurred, hist):
     """
     Return an image, where all the pixels brighter than a threshold
     are made saturated, and all those below average are zeroed.
     the threshhold is chosen as the local minimum of a cubic polynomial fit of the pixel-brightness
     histogram of the image. As a backup, the average brightness is used if
     a local minimum cannot be found.
-    IN: original image
+    The 20-bin histogram is read from the 16-bit histogram of the blurred image
+    (np.bincount) so no float copy of the image is made.
+    IN: blurred 16-bit image, its np.bincount histogram (65536 bins)
     OUT: modified image
     """
-
-    thresh = 0.9 * np.sum(image) / (image.shape[0] * image.shape[1])
+    cdf = np.cumsum(hist)
+    thresh = 0.9 * np.dot(hist, np.arange(hist.shape[0])) / cdf[-1]
     print('thresh=', thresh)
-    img_blurred = cv2.blur(image, ksize=(5, 5))
-    n, bins = np.histogram(img_blurred.flatten(), bins=20)
-    '''
-    plt.hist(img_blurred.flatten(), bins=20)
-    plt.show()
-    '''
+    # same 20 bins as np.histogram: [bins[i], bins[i+1]), the last one closed
+    bins = np.linspace(np.argmax(hist > 0), hist.shape[0] - 1 - np.argmax(hist[::-1] > 0), 21)
+    below = np.zeros(21, dtype=cdf.dtype)  # number of pixels strictly below each bin edge
+    ceil_edges = np.ceil(bins).astype(int)
+    below[ceil_edges > 0] = cdf[ceil_edges[ceil_edges > 0] - 1]
+    below[-1] = cdf[-1]
+    n = np.diff(below)
     # fit the histogram to a cubic graph
     coeff = polynomial.polynomial.Polynomial.fit(bins[1:], n, 3).convert().coef
     print('cubic fit coeffs. :', coeff)
 
     d, c, b, a = coeff
 
-    def gf(x):
-        return a * x**3 + b * x**2 + c * x + d
-
-    '''
-    y_fitted = [gf(x) for x in bins[1:]]
-    plt.plot(bins[1:], y_fitted)
-    plt.plot(bins[1:], n)
-    plt.show()
-    '''
-
     # derivative is 3 * a * x**2 + 2 * b * x + c
     # stationary points at {-2b +/- sqrt(4*b**2-12*a*c)} / 6a
 
@@ -211,14 +213,14 @@ def get_flood_image(image):
         thresh3 = bins[i]
 
     print('thresh3 = ', thresh3)
-    img_blurred[img_blurred < thresh3] = 0
-    img_blurred[img_blurred >= thresh3] = 65000
-    return img_blurred
+    # integer pixels >= thresh3 are those > ceil(thresh3) - 1
+    _, img_flooded = cv2.threshold(img_blurred, math.ceil(thresh3) - 1, 65000, cv2.THRESH_BINARY)
+    return img_flooded.astype(np.float32)
 
 
-def get_edge_list(image, sigma=2):
+def get_edge_list(image, sigma=2, num_reg=NUM_REG):
     """from a picture, return a numpy array containing edge points
-    IN : frame as numpy array, integer
+    IN : 16-bit frame as numpy array, integer, number of edge regions kept
     OUT : numpy array
     TODO: simplify this function?
     """
@@ -226,10 +228,12 @@ def get_edge_list(image, sigma=2):
         logme('ERROR: could not find any edges')
         return image, (-1, -1, -1)
 
-    low_threshold = np.median(cv2.blur(image, ksize=(5, 5))) / 10
+    img_blurred = cv2.blur(image, ksize=(5, 5))
+    hist = np.bincount(img_blurred.ravel(), minlength=65536)
+    low_threshold = get_percentiles(img_blurred, [50], hist)[0] / 65536 / 10
     high_threshold = low_threshold * 1.5
     print('using thresholds:', low_threshold, high_threshold)
-    image_flooded = get_flood_image(image)
+    image_flooded = get_flood_image(img_blurred, hist)
     edges = skimage.feature.canny(
         image=image_flooded,
         sigma=sigma,
@@ -241,10 +245,10 @@ def get_edge_list(image, sigma=2):
         edges, structure=[[1, 1, 1], [1, 1, 1], [1, 1, 1]])
     if nf == 0:
         # try again with less blur, hope it will work
-        return get_edge_list(image, sigma=sigma - 0.5)
+        return get_edge_list(image, sigma=sigma - 0.5, num_reg=num_reg)
     region_sizes = [-1] + [np.sum(labelled == i) for i in range(1, nf + 1)]
     filt = np.zeros(edges.shape)
-    for label in sorted(region_sizes, reverse=True)[:min(nf, NUM_REG)]:
+    for label in sorted(region_sizes, reverse=True)[:min(nf, num_reg)]:
         filt[labelled == region_sizes.index(label)] = 1
 
     X = np.argwhere(filt)  # find the non-zero pixels
@@ -267,17 +271,187 @@ def get_edge_list(image, sigma=2):
     return np.array([X, raw_X], dtype=object)
 
 
+def downscaled_edge_list(image, factor=4, num_reg=NUM_REG):
+    """edge points of a 16-bit image, found on the image downscaled by factor
+    IN : 16-bit frame as numpy array, downscaling factor, number of edge regions kept
+    OUT : numpy array of [edge points (y, x), raw edge points] in the coordinates of image
+    """
+    h, w = image.shape[0] // factor, image.shape[1] // factor
+    # block mean on the 16-bit data, same as downscale_local_mean
+    small = cv2.resize(image[:h * factor, :w * factor], (w, h), interpolation=cv2.INTER_AREA)
+    return get_edge_list(small, num_reg=num_reg) * factor  # down-scaled, then upscaled back
+
+
+def coarse_factor(image):
+    """downscaling factor of the coarse fit: COARSE_FACTOR, smaller to keep at least 64 pixels on each side"""
+    return max(1, min(COARSE_FACTOR, min(image.shape) // 64))
+
+
+def refine_limb(image, points, center, factor):
+    """
+    sub-pixel limb points at full resolution: along the ray from the centre of the coarse fit
+    through each coarse edge point, the limb is the steepest brightness drop in a thin annulus
+    around the coarse point (profiles sampled every half pixel, averaged over 3 parallel rays)
+    IN : 16-bit image, coarse edge points (y, x), centre (y, x) of the coarse fit, downscaling factor of the coarse fit
+    OUT : limb points (y, x)
+    """
+    d = points - center
+    dist = np.linalg.norm(d, axis=1)
+    u = d / dist[:, np.newaxis]
+    # one ray per direction
+    bins = ((np.arctan2(u[:, 0], u[:, 1]) + np.pi) / (2 * np.pi) * LIMB_ANGLES).astype(int) % LIMB_ANGLES
+    _, first = np.unique(bins, return_index=True)
+    u, dist = u[first], dist[first]
+
+    half = 2 * factor + 4 # half width of the annulus: the coarse points are within about factor pixels of the limb
+    s = np.arange(-2 * half, 2 * half + 1) / 2
+    r = dist[:, np.newaxis] + s
+    profiles = 0
+    for t in (-1, 0, 1): # parallel rays, t pixels aside
+        map_y = center[0] + u[:, 0:1] * r + t * u[:, 1:2]
+        map_x = center[1] + u[:, 1:2] * r - t * u[:, 0:1]
+        profiles = profiles + cv2.remap(image, map_x.astype(np.float32), map_y.astype(np.float32), cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE).astype(np.float32)
+    slope = np.gradient(gaussian_filter1d(profiles, 2, axis=1), axis=1)
+
+    position = find_line_minima(slope) # steepest drop going outwards, sub-pixel
+    k = np.rint(position).astype(int)
+    drop = -slope[np.arange(k.shape[0]), k]
+    # weak drops (no limb) and drops at the ends of the annulus (limb further) rejected
+    keep = (drop > 0.25 * np.median(drop)) & (k > 1) & (k < s.shape[0] - 2)
+    radius = dist + s[0] + position * (s[1] - s[0])
+    return (center + u * radius[:, np.newaxis])[keep]
+
+
+def ellipse_distance(points, coefficients):
+    """distance of the points (y, x) to the ellipse of an LsqEllipse fit, to first order"""
+    a, b, c, d, e, f = coefficients
+    y, x = points[:, 0], points[:, 1]
+    return (a*y*y + b*y*x + c*x*x + d*y + e*x + f) / np.hypot(2*a*y + b*x + d, b*y + 2*c*x + e)
+
+
+def clip_limb(points):
+    """
+    reject the refined points off the limb (edge of a partial disk, prominences ...): the ellipse
+    through LIMB_SAMPLE random points with most points within 1 pixel is found first (trials
+    stopped when 90 % of the points are within 1 pixel), then
+    ellipse fit and points further than 3 sigma (at least 1 pixel) removed, repeated
+    IN : limb points (y, x)
+    OUT : limb points kept
+    """
+    if points.shape[0] < MIN_LIMB_POINTS:
+        return points
+    rng = np.random.default_rng(0) # same result for the same points
+    kept, best = np.ones(points.shape[0], dtype=bool), MIN_LIMB_POINTS - 1
+    for _ in range(LIMB_TRIALS):
+        sample = points[rng.choice(points.shape[0], LIMB_SAMPLE, replace=False)]
+        try:
+            inliers = np.abs(ellipse_distance(points, LsqEllipse().fit(sample).coefficients)) < 1
+        except (ValueError, np.linalg.LinAlgError): # degenerate sample
+            continue
+        if np.count_nonzero(inliers) > best:
+            kept, best = inliers, np.count_nonzero(inliers)
+            if best >= 0.9 * points.shape[0]:
+                break
+    for _ in range(LIMB_CLIP_ITER):
+        try:
+            dist = ellipse_distance(points, LsqEllipse().fit(points[kept]).coefficients)
+        except (ValueError, np.linalg.LinAlgError):
+            break
+        dist -= np.median(dist[kept])
+        new_kept = np.abs(dist) < max(1, 3 * 1.4826 * np.median(np.abs(dist[kept])))
+        if np.array_equal(new_kept, kept) or np.count_nonzero(new_kept) < MIN_LIMB_POINTS:
+            break
+        kept = new_kept
+    return points[kept]
+
+
+def close_fits(coarse, refined):
+    """IN : two_step results, OUT : True if the ratio, radius and centre of the refined fit are within LIMB_MAX_CHANGE of the coarse fit"""
+    center, height, _, ratio = coarse[:4]
+    return (abs(refined[3] / ratio - 1) < LIMB_MAX_CHANGE and abs(refined[1] / height - 1) < LIMB_MAX_CHANGE
+            and np.linalg.norm(refined[0] - center) < LIMB_MAX_CHANGE * height)
+
+
+def fit_circle(points):
+    """algebraic circle fit, IN : (x, y) points, OUT : centre, radius"""
+    A = np.column_stack((2 * points, np.ones(len(points))))
+    (a, b, c), *_ = np.linalg.lstsq(A, np.sum(points**2, axis=1), rcond=None)
+    return np.array([a, b]), math.sqrt(c + a**2 + b**2)
+
+
+def fit_tilt(image, ratio):
+    """tilt angle of a disk with a known Y/X ratio (from the scan speed): the limb points, refined at
+    full resolution, corrected with this ratio and the tilt angle are on a circle, least squares fit
+    of the tilt, centre and radius
+    IN : 16-bit disk, Y/X ratio
+    OUT : tilt angle (radians)
+    """
+    X = downscaled_edge_list(image, CIRCLE_FACTOR)[0]
+    centre, _ = fit_circle(X[:, ::-1])  # the rays only need a rough centre
+    X = clip_limb(refine_limb(image, X, centre[::-1], CIRCLE_FACTOR))[:, ::-1]  # (x, y)
+
+    def residuals(p):
+        mat = np.linalg.inv(get_correction_matrix(p[0], ratio)[0])  # as correct_image
+        return np.linalg.norm(X @ mat.T - p[1:3], axis=1) - p[3]
+
+    centre, radius = fit_circle(X @ np.linalg.inv(get_correction_matrix(0.0, ratio)[0]).T)
+    fit = least_squares(residuals, np.concatenate([[0.0], centre, [radius]]), loss='soft_l1', f_scale=2.0, x_scale='jac')
+    return (fit.x[0] + math.pi / 4) % (math.pi / 2) - math.pi / 4
+
+
+def circle_with_geometry(image, options, ratio, phi):
+    """apply a known geometry correction and find the disk with a circle fit only, cheaper
+    and more robust than the ellipse fit for noisy scans. The geometry is checked with an
+    ellipse fit of the limb of the corrected disk refined at full resolution: a wrong ratio
+    or tilt angle leaves an ellipse (a tilt error of 3 degrees an axis ratio of about 1.01)
+    IN : 16-bit disk, options, Y/X ratio, tilt angle (radians)
+    OUT : circularised picture, circle (centre x, centre y, radius), borders, axis ratio of the corrected disk (inf if not found)
+    """
+    fix_img = correct_image(np.divide(image, 65536, dtype=options['precision']), phi, ratio, np.array([-1.0, -1.0]), -1.0, print_log=True)[0]
+    X = downscaled_edge_list(fix_img, CIRCLE_FACTOR)[0][:, ::-1]  # (x, y)
+    for _ in range(2):  # second pass without the outliers (prominences, edges of a partial disk)
+        (cx, cy), radius = fit_circle(X)
+        res = np.linalg.norm(X - (cx, cy), axis=1) - radius
+        X = X[np.abs(res) < 3 * np.std(res) + 1]
+    borders = [np.min(X[:, 0]), np.min(X[:, 1]), np.max(X[:, 0]), np.max(X[:, 1])]
+    try:
+        limb = clip_limb(refine_limb(fix_img, X[:, ::-1], np.array([cy, cx]), CIRCLE_FACTOR))
+        angle, axis_ratio = two_step(limb)[2:4] if limb.shape[0] >= MIN_LIMB_POINTS else (0, np.inf)
+    except (ValueError, np.linalg.LinAlgError):
+        angle, axis_ratio = 0, np.inf
+    axis_ratio = max(axis_ratio, 1 / axis_ratio)
+    logme('Disk position, radius : ' + "[{:.3f} {:.3f}], {:.3f}".format(cx, cy, radius) + ', axis ratio of the corrected disk : '
+          + "{:.4f}".format(axis_ratio) + ' (angle ' + "{:.1f}".format(math.degrees(angle)) + ' degrees)')
+    return fix_img, (cx, cy, radius), borders, axis_ratio
+
+
 def ellipse_to_circle(image, options, basefich):
     """from an entire sun frame, compute ellipse fit and return a circularise picture and center coordinates
     IN : numpy array, dictionnayr of options
     OUt :numpy array, numpy array (2 elements)
     """
-    image = image / 65536  # assume 16 bit
-    factor = 4
-    processed = get_edge_list(downscale_local_mean(
-        image, (factor, factor))) * factor  # down-scaled, then upscaled back
-    X, raw_X = processed[0], processed[1]
-    center, height, phi, ratio, X_f, ellipse_points = two_step(X)
+    # coarse fit on the downscaled image, then fit again on the limb refined at full resolution
+    factor = coarse_factor(image)
+    X, raw_X = downscaled_edge_list(image, factor)
+    coarse = two_step(X)
+    center, height, phi, ratio, X_f, ellipse_points = coarse
+    try:
+        X = clip_limb(refine_limb(image, X_f, center, factor))
+        refined = two_step(X) if X.shape[0] >= MIN_LIMB_POINTS else None
+    except (ValueError, np.linalg.LinAlgError):
+        refined = None
+    # the refined fit is kept only close to the coarse one: a few limb points left on a short arc can give any ellipse
+    if refined is not None and not close_fits(coarse, refined) and factor > FALLBACK_FACTOR:
+        # coarse fit of a partial disk less reliable on the small image: fitted again as before the refinement
+        X, raw_X = downscaled_edge_list(image, FALLBACK_FACTOR)
+        coarse = two_step(X)
+        center, height, phi, ratio, X_f, ellipse_points = coarse
+    if refined is not None and close_fits(coarse, refined):
+        center, height, phi, ratio, X_f, ellipse_points = refined
+        logme('Ellipse fit : ' + str(refined[4].shape[0]) + ' limb points refined, coarse fit downscaled by ' + str(factor))
+    else:
+        logme('WARNING : limb refinement rejected, coarse ellipse fit used')
+    image = np.divide(image, 65536, dtype=options['precision'])  # assume 16 bit
     center = np.array([center[1], center[0]])
 
     fix_img, new_circle, mat3 = correct_image(image, phi, ratio, center, height, print_log=True)
@@ -289,7 +463,7 @@ def ellipse_to_circle(image, options, basefich):
     X_f3_t = (np.linalg.inv(mat3) @ X_f3.T).T
     borders = [np.min(X_f3_t[:, 0]), np.min(X_f3_t[:, 1]), np.max(X_f3_t[:, 0]), np.max(X_f3_t[:, 1])]
     print('sun borders found:' + str(borders))
-    if not options['clahe_only']:
+    if options['write_files'] and not options['clahe_only']:
         fig = matplotlib.figure.Figure()
         ax = [[fig.add_subplot(2, 2, 1), fig.add_subplot(2, 2, 2)], [fig.add_subplot(2, 2, 3), fig.add_subplot(2, 2, 4)]]
         #fig, ax = plt.subplots(ncols=2, nrows=2)
@@ -0,0 +1,198 @@
+"""
+Version 19 October 2026
+
+------------------------------------------------------------------------
+Mosaic of partial-disk scans (slit shorter than the solar diameter): each scan holds
+a part of the limb only, so the ellipse fit of a single scan is not possible.
+- the limb fragments of each scan are refined at full resolution, then the fragments
+  of all the scans are fitted together: one geometry correction
+  (Y/X ratio and tilt) and one radius for all the scans, one disk centre per scan
+- each scan is warped into a common frame where the disk is a circle
+- overlaps are blended with weights decreasing near the edges of each scan
+- the output is assembled tile by tile in a memory-mapped file, the scans are read
+  from memory-mapped files too
+------------------------------------------------------------------------
+
+"""
+import os
+import math
+import numpy as np
+import cv2
+from astropy.io import fits
+from scipy.optimize import least_squares
+
+from solex_util import logme, image_process
+from ellipse_to_circle import downscaled_edge_list, get_correction_matrix, fit_circle, refine_limb, clip_limb
+
+MOSAIC_NUM_REG = 4 # the limb of a partial scan can be cut in several edge regions
+MOSAIC_FACTOR = 4 # downscaling factor of the edge detection
+EDGE_MARGIN = 8 # edge points this close to the border of a scan are the border, not the limb
+
+
+def limb_points(image):
+    """
+    limb points of a partial scan, without the edges found where the disk is cut by
+    the border of the scan: a limb point has a large brightness step around it. The
+    edge points of the downscaled image are refined at full resolution along the rays
+    from the centre of a circle fit (see ellipse_to_circle.refine_limb) and the points
+    off the limb removed (clip_limb)
+    IN : 16-bit disk image of a partial scan
+    OUT : (x, y) limb points
+    """
+    X = downscaled_edge_list(image, MOSAIC_FACTOR, num_reg=MOSAIC_NUM_REG)[0]
+    h, w = image.shape
+
+    def inside(X):
+        return X[(X[:, 0] > EDGE_MARGIN) & (X[:, 0] < h - EDGE_MARGIN) & (X[:, 1] > EDGE_MARGIN) & (X[:, 1] < w - EDGE_MARGIN)]
+
+    X = inside(X)
+    step = cv2.morphologyEx(cv2.blur(image, (5, 5)), cv2.MORPH_GRADIENT, np.ones((15, 15), np.uint8))
+    low, high = np.percentile(image, [1, 99])
+    X = X[step[X[:, 0].astype(int), X[:, 1].astype(int)] > 0.2 * (high - low)]
+    if X.shape[0] < 3:
+        return X[:, ::-1]
+    centre, _ = fit_circle(X[:, ::-1]) # the rays only need a rough centre
+    return inside(clip_limb(refine_limb(image, X, centre[::-1], MOSAIC_FACTOR)))[:, ::-1]
+
+
+def correction_to_ratio_phi(C):
+    """Y/X ratio and tilt angle (radians) of an upper triangular correction matrix, as get_correction_matrix"""
+    w, v = np.linalg.eigh(C.T @ C)
+    for k in range(2):
+        phi = math.atan2(-v[1, k], v[0, k])
+        phi = (phi + math.pi / 2) % math.pi - math.pi / 2
+        if abs(phi) <= math.pi / 4:
+            return math.sqrt(w[k] / w[1 - k]), phi
+    return 1.0, 0.0
+
+
+def fit_shared_geometry(point_sets, ratio=1.0, phi=0.0):
+    """
+    fit of the limb fragments of several scans: corrected coordinates C @ (p - centre)
+    are on a circle, with C = [[a, b], [0, 1]] and the radius the same for all the scans
+    IN : list of (x, y) limb points of each scan, initial Y/X ratio and tilt angle (radians)
+    OUT : correction matrix C, radius, list of centres (scan coordinates), rms error (pixels)
+    """
+    C0 = np.linalg.inv(get_correction_matrix(phi, ratio)[0])
+    centres, radii = [], []
+    for points in point_sets:
+        centre, radius = fit_circle(points @ C0.T)
+        centres.append(np.linalg.solve(C0, centre))
+        radii.append(radius)
+
+    def residuals(p):
+        C = np.array([[p[0], p[1]], [0, 1]])
+        return np.concatenate([np.linalg.norm((points - p[3 + 2 * i: 5 + 2 * i]) @ C.T, axis=1) - p[2]
+                               for i, points in enumerate(point_sets)])
+
+    p0 = np.concatenate([[C0[0, 0], C0[0, 1], np.median(radii)]] + centres)
+    fit = least_squares(residuals, p0, loss='soft_l1', f_scale=2.0, x_scale='jac')
+    res = residuals(fit.x)
+    rms = math.sqrt(np.mean(res[np.abs(res) < 3 * np.median(np.abs(res)) + 1]**2))
+    C = np.array([[fit.x[0], fit.x[1]], [0, 1]])
+    return C, fit.x[2], [fit.x[3 + 2 * i: 5 + 2 * i] for i in range(len(point_sets))], rms
+
+
+class Mosaic:
+    """partial scans, added one scan at a time (see Solex_recon.solex_proc results), assembled by finish"""
+
+    def __init__(self, file_, feather=32, tile=1024):
+        self.base = os.path.splitext(file_)[0] + '_mosaic'
+        self.feather = feather
+        self.tile = tile
+        self.scans = [] # (memory-mapped file, shape, limb points)
+        self.shifts = None
+
+    def scan_options(self, options):
+        """options for solex_proc: no geometry correction (done here for all the scans), no width crop"""
+        return dict(options, ratio_fixe=1.0, slant_fix=0.0, fixed_width=None, crop_width_square=False, keep_arrays=True)
+
+    def add(self, results):
+        """
+        store the disks of one partial scan and find its limb
+        IN : solex_proc results, run with scan_options
+        """
+        shifts = sorted(results['shifts'])
+        if self.shifts is None:
+            self.shifts = shifts
+            self.header = results['header']
+        elif shifts != self.shifts:
+            raise ValueError('all the scans of a mosaic need the same pixel shifts')
+        images = np.stack([results['shifts'][s]['detransversaliumed'] for s in shifts])
+        points = limb_points(results['shifts'][min(shifts, key=abs)]['circular']) # before the transversalium correction
+        logme(f'Mosaic scan {len(self.scans) + 1} : {len(points)} limb points')
+        path = self.base + '_' + str(len(self.scans)) + '.npy'
+        np.save(path, images)
+        self.scans.append((path, images.shape[1:], points))
+
+    def discard(self):
+        """remove the scans stored without assembling them (batch cancelled)"""
+        for path, _, _ in self.scans:
+            os.remove(path)
+        self.scans = []
+
+    def finish(self, options):
+        """
+        fit the geometry, assemble, process and save one mosaic per pixel shift, remove the temporary files
+        OUT : {shift: mosaic (uint16)}
+        """
+        if not self.scans:
+            return {}
+        ratio = options['ratio_fixe'] if options['ratio_fixe'] is not None else 1.0
+        phi = math.radians(options['slant_fix']) if options['slant_fix'] is not None else 0.0
+        C, radius, centres, rms = fit_shared_geometry([points for _, _, points in self.scans], ratio, phi)
+        ratio, phi = correction_to_ratio_phi(C)
+        logme(f'Mosaic of {len(self.scans)} scans : Y/X ratio {ratio:.3f}, tilt angle {math.degrees(phi):.3f} degrees, radius {radius:.2f}, rms limb error {rms:.2f} pixels')
+
+        # common frame: the corrected coordinates, shifted so that all the scans are inside
+        mats = [np.column_stack((C, -C @ centre)) for centre in centres]
+        corners = np.concatenate([(m[:, :2] @ np.array([[0, 0], [w, 0], [0, h], [w, h]]).T).T + m[:, 2]
+                                  for m, (_, (h, w), _) in zip(mats, self.scans)])
+        origin = np.floor(corners.min(axis=0))
+        W, H = (np.ceil(corners.max(axis=0)) - origin).astype(int)
+        for m in mats:
+            m[:, 2] -= origin
+        circle = (-origin[0], -origin[1], radius)
+        logme(f'Mosaic size : {W} x {H}, disk centre {circle[0]:.1f} {circle[1]:.1f}')
+
+        out = np.lib.format.open_memmap(self.base + '.npy', mode='w+', dtype='uint16', shape=(len(self.shifts), H, W))
+        for ty in range(0, H, self.tile):
+            for tx in range(0, W, self.tile):
+                th, tw = min(self.tile, H - ty), min(self.tile, W - tx)
+                acc = np.zeros((len(self.shifts), th, tw), dtype='float32')
+                wsum = np.zeros((th, tw), dtype='float32')
+                for m, (path, (h, w), _) in zip(mats, self.scans):
+                    A = m.copy()
+                    A[:, 2] -= (tx, ty)
+                    # weights: distance to the border of the scan, in scan pixels
+                    inv = cv2.invertAffineTransform(A)
+                    x, y = np.meshgrid(np.arange(tw, dtype='float32'), np.arange(th, dtype='float32'))
+                    sx = inv[0, 0] * x + inv[0, 1] * y + inv[0, 2]
+                    sy = inv[1, 0] * x + inv[1, 1] * y + inv[1, 2]
+                    weight = np.clip((np.minimum(np.minimum(sx, w - 1 - sx), np.minimum(sy, h - 1 - sy)) + 1) / self.feather, 0, 1)
+                    if not weight.any():
+                        continue
+                    images = np.load(path, mmap_mode='r')
+                    for k in range(len(self.shifts)):
+                        acc[k] += cv2.warpAffine(np.ascontiguousarray(images[k]), A, (tw, th), flags=cv2.INTER_LINEAR) * weight
+                    del images # release the memory-mapped file
+                    wsum += weight
+                out[:, ty:ty + th, tx:tx + tw] = np.clip(np.rint(acc / np.maximum(wsum, 1e-6)), 0, 65535)
+        out.flush()
+
+        hdr = self.header.copy()
+        hdr['NMOSAIC'] = len(self.scans)
+        mosaics = {}
+        for k, shift in enumerate(self.shifts):
+            img = np.array(out[k])
+            basefich = self.base + '_shift=' + str(shift)
+            if options['write_files']:
+                fits.PrimaryHDU(img, header=hdr).writeto(basefich + '.fits', overwrite='True')
+            image_process(img, circle, options, hdr, basefich)
+            mosaics[shift] = img
+        del out
+        for path, _, _ in self.scans:
+            os.remove(path)
+        os.remove(self.base + '.npy')
+        self.scans = []
+        return mosaics
@@ -0,0 +1,90 @@
+"""
+Version 19 October 2026
+
+------------------------------------------------------------------------
+Profiling of the processing of each file (SHG_MAIN --profile), to report performance
+issues with data that can be reproduced:
+- cProfile statistics saved as a pstats dump (file_profile.pstats, for pstats, snakeviz ...)
+- stacks of the processing thread sampled every few milliseconds, saved in the collapsed
+  format of the flame graph tools (file_profile_collapsed.txt, one "f1;f2;f3 count" line
+  per stack, for flamegraph.pl, speedscope, inferno ...)
+- table of the functions with the largest cumulative time, printed after each file
+------------------------------------------------------------------------
+
+"""
+import os
+import sys
+import time
+import pstats
+import cProfile
+import threading
+import contextlib
+from collections import Counter
+
+SAMPLE_INTERVAL = 0.005 # seconds between two stack samples
+DEFAULT_TOP = 25 # functions in the printed table
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return code.co_name + ' (' + os.path.basename(code.co_filename) + ':' + str(code.co_firstlineno) + ')'
+
+
+class StackSampler:
+    """samples the stack of one thread from a background thread"""
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def write_collapsed(self, path):
+        with open(path, 'w') as fp:
+            for stack, count in sorted(self.stacks.items()):
+                fp.write(stack + ' ' + str(count) + '\n')
+
+
+@contextlib.contextmanager
+def profile_file(file_, top=None):
+    """
+    profile the code run in the context, nothing if top is None
+    IN : video file (the profiles are written next to it), number of functions printed
+    """
+    if top is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    sampler = StackSampler(threading.get_ident())
+    start = time.time()
+    sampler.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        sampler.stop()
+        base = os.path.splitext(file_)[0] + '_profile'
+        profiler.dump_stats(base + '.pstats')
+        sampler.write_collapsed(base + '_collapsed.txt')
+        print(f'---- profile of {file_} : {time.time() - start:.2f} s, {sum(sampler.stacks.values())} stack samples')
+        print('pstats dump : ' + base + '.pstats, collapsed stacks : ' + base + '_collapsed.txt')
+        pstats.Stats(profiler, stream=sys.stdout).strip_dirs().sort_stats('cumulative').print_stats(top)
@@ -0,0 +1,238 @@
+"""
+Version 19 October 2026
+
+------------------------------------------------------------------------
+Output-equivalence check of the reconstruction, for changes that should not change
+the results (faster reading, other float type, vectorized code ...).
+- deterministic synthetic SER files are generated (and real SER/AVI files can be added)
+- Solex_recon.solex_proc is run on each of them with several sets of options
+- every FITS, PNG and npy file written and the geometry found (circle, Y/X ratio, tilt,
+  borders) are compared with a reference run, and the differences are reported
+- a scan stacked with itself must be registered with a scale of 1 and a shift of 0
+
+python regression_check.py run REFDIR [file.ser ...]        reference run (before the change)
+python regression_check.py check REFDIR [tolerance]         new run (after the change) compared with REFDIR
+python regression_check.py compare REFDIR NEWDIR [tolerance] compare two runs
+python regression_check.py stack                             stacking of a scan with itself
+tolerance : largest difference accepted for an image pixel (0 by default: identical images)
+------------------------------------------------------------------------
+
+"""
+import os
+import sys
+import json
+import copy
+import shutil
+import struct
+import tempfile
+import numpy as np
+import cv2
+from astropy.io import fits
+
+import Solex_recon as sol
+import SHG_MAIN
+from stack_scans import Stacker
+
+# options changed from the SHG_MAIN defaults for each run
+CASES = {
+    'default': {'shift': [0, -3, 3], 'save_fit': True},
+    'fixed_geometry': {'ratio_fixe': 1.1, 'slant_fix': 1.7, 'save_fit': True},
+    'doppler': {'doppler_picture': 3, 'velocity_map': 3, 'line_drift': 50},
+    'crop_rotate': {'crop_width_square': True, 'flip_x': True, 'img_rotate': 90},
+    'float64': {'precision': 'float64', 'shift': [0, 2]},
+}
+
+# synthetic files: parameters of write_synthetic_ser
+SYNTHETIC = {
+    'synthetic16': {'seed': 0, 'depth': 16, 'timestamps': True},
+    'synthetic8': {'seed': 1, 'depth': 8, 'ratio': 0.95, 'tilt': -0.02},
+}
+
+PLOTS = ('_ellipse_fit.png', '_spectral_line_data.png', '_transversalium_correction.png') # diagnostic plots, not compared
+GEOMETRY_TOLERANCE = 1e-6 # largest difference accepted for the geometry values (pixels, degrees)
+FIXTURES_FILE = 'fixtures.json'
+
+
+def write_synthetic_ser(path, width=120, height=420, n_frames=460, ratio=1.1, tilt=0.03, depth=16, timestamps=False, seed=0):
+    """
+    SER file of a limb-darkened disk scanned across a curved spectral line, with a textured
+    surface, transversalium lines and noise; the same file for the same parameters
+    IN : path, frame size, number of frames, Y/X ratio and tilt (pixels per frame) of the
+    scan, bit depth (8 or 16), add a trailer of frame time stamps, random seed
+    """
+    rng = np.random.default_rng(seed)
+    cx, cy, r = n_frames / 2, height / 2, 0.36 * height
+    col = np.arange(width)[np.newaxis, :]
+    rows = np.arange(height)
+    line = 0.45 * width + 0.0002 * (rows - 0.48 * height)**2 + 0.01 * (rows - 0.48 * height)
+    profile = 1 - 0.6 * np.exp(-0.5 * ((col - line[:, np.newaxis]) / 2.5)**2)
+    trans = 1 + 0.03 * np.sin(rows / 3.0)
+    texture = 1 + 0.05 * rng.standard_normal((height, n_frames))
+    frames = np.empty((n_frames, height, width), dtype='uint16')
+    for t in range(n_frames):
+        d2 = ((t - cx) / (r / ratio))**2 + ((rows - cy - tilt * (t - cx)) / r)**2
+        intensity = np.where(d2 < 1, 30000 * (0.4 + 0.6 * np.sqrt(np.clip(1 - d2, 0, 1))) * texture[:, t], 400)
+        frames[t] = np.clip(intensity[:, np.newaxis] * profile * trans[:, np.newaxis] + rng.normal(0, 30, (height, width)), 0, 65535)
+    header = b'LUCAM-RECORDER' + struct.pack('<7I', 0, 0, 1, width, height, depth, n_frames)
+    header += b'Observer'.ljust(40) + b'ZWO ASI178MM'.ljust(40) + b'Telescope'.ljust(40) + struct.pack('<qq', 0, 0)
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.write((frames >> 8).astype('uint8').tobytes() if depth == 8 else frames.astype('<u2').tobytes())
+        if timestamps:
+            f.write((638000000000000000 + np.arange(n_frames, dtype='<i8') * 100000).tobytes()) # 10 ms per frame
+
+
+def run_file(file_, directory, case_options):
+    """
+    process file_ as if it was in directory (the outputs are written next to the video file)
+    IN : video file, output directory, options changed from the SHG_MAIN defaults
+    """
+    os.makedirs(directory, exist_ok=True)
+    video = os.path.join(directory, os.path.basename(file_))
+    try:
+        os.link(file_, video)
+    except OSError:
+        shutil.copy(file_, video)
+    options = copy.deepcopy(SHG_MAIN.options)
+    options.update(copy.deepcopy(case_options))
+    try:
+        results = sol.solex_proc(video, options)
+    finally:
+        os.remove(video)
+    geometry = {'circle': results['circle'], 'ratio': results['ratio'], 'slant': results['slant'], 'borders': results['borders']}
+    with open(os.path.join(directory, 'geometry.json'), 'w') as fp:
+        json.dump(geometry, fp, indent=4, default=float)
+
+
+def run(directory, files=()):
+    """run all the cases on the synthetic files and on files, results in directory"""
+    fixtures = os.path.join(directory, 'fixtures')
+    os.makedirs(fixtures, exist_ok=True)
+    videos = []
+    for name, params in SYNTHETIC.items():
+        videos.append(os.path.join(fixtures, name + '.ser'))
+        write_synthetic_ser(videos[-1], **params)
+    videos += [os.path.abspath(f) for f in files]
+    with open(os.path.join(directory, FIXTURES_FILE), 'w') as fp:
+        json.dump([os.path.abspath(f) for f in files], fp, indent=4)
+    for case, case_options in CASES.items():
+        for video in videos:
+            print('---- ' + case + ' : ' + video)
+            run_file(video, os.path.join(directory, case, os.path.splitext(os.path.basename(video))[0]), case_options)
+
+
+def read_product(path):
+    """image or array of an output file"""
+    if path.endswith('.fits'):
+        return fits.getdata(path)
+    if path.endswith('.png'):
+        return cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    return np.load(path)
+
+
+def compare_arrays(ref, new, tolerance):
+    """OUT : description of the differences (None if identical), True if beyond tolerance"""
+    if ref.shape != new.shape:
+        return 'shape ' + str(ref.shape) + ' -> ' + str(new.shape), True
+    delta = new.astype('d') - ref.astype('d')
+    n = np.count_nonzero(delta)
+    if n == 0:
+        return None, False
+    worst = np.max(np.abs(delta))
+    return (f'max |delta| {worst:g}, {n} values ({100 * n / delta.size:.3f} %) differ, mean delta {np.mean(delta):.4g}'), worst > tolerance
+
+
+def compare_geometry(ref, new):
+    """OUT : list of (name, reference, new value, beyond GEOMETRY_TOLERANCE)"""
+    deltas = []
+    for key in ref:
+        a, b = np.ravel(np.array(ref[key], dtype='d')), np.ravel(np.array(new.get(key), dtype='d'))
+        if a.shape != b.shape or np.any(np.abs(a - b) > 0) or np.isnan(b).any() != np.isnan(a).any():
+            deltas.append((key, ref[key], new.get(key), a.shape != b.shape or not np.all(np.abs(a - b) <= GEOMETRY_TOLERANCE)))
+    return deltas
+
+
+def compare(ref_dir, new_dir, tolerance=0):
+    """
+    compare the products of two runs and print the differences
+    IN : directories of the reference and new runs, largest difference accepted for an image pixel
+    OUT : number of products beyond tolerance (missing files included)
+    """
+    failures, identical = 0, 0
+    for root, dirs, files in os.walk(ref_dir):
+        dirs[:] = [d for d in dirs if d != 'fixtures']
+        rel = os.path.relpath(root, ref_dir)
+        new_files = set(os.listdir(os.path.join(new_dir, rel))) if os.path.isdir(os.path.join(new_dir, rel)) else set()
+        for name in sorted(files):
+            if not name.endswith(('.fits', '.png', '.npy', 'geometry.json')) or name.endswith(PLOTS):
+                continue
+            label = os.path.join(rel, name)
+            if name not in new_files:
+                print(label + ' : MISSING')
+                failures += 1
+                continue
+            if name == 'geometry.json':
+                with open(os.path.join(root, name)) as fp1, open(os.path.join(new_dir, rel, name)) as fp2:
+                    deltas = compare_geometry(json.load(fp1), json.load(fp2))
+                for key, a, b, bad in deltas:
+                    print(label + ' : ' + key + ' ' + str(a) + ' -> ' + str(b) + (' FAILED' if bad else ''))
+                failures += any(bad for *_, bad in deltas)
+                identical += not deltas
+                continue
+            text, bad = compare_arrays(read_product(os.path.join(root, name)), read_product(os.path.join(new_dir, rel, name)), tolerance)
+            if text is None:
+                identical += 1
+            else:
+                print(label + ' : ' + text + (' FAILED' if bad else ''))
+                failures += bad
+        for name in sorted(new_files - set(files)):
+            if name.endswith(('.fits', '.png', '.npy')) and not name.endswith(PLOTS):
+                print(os.path.join(rel, name) + ' : NEW FILE')
+    print(f'{identical} products identical, {failures} beyond tolerance')
+    return failures
+
+
+def check_stack(directory):
+    """
+    stack the synthetic scan with itself: the second scan must be applied the identity matrix
+    IN : working directory
+    OUT : 1 if the registration is not the identity, else 0
+    """
+    video = os.path.join(directory, 'stack.ser')
+    write_synthetic_ser(video, **SYNTHETIC['synthetic16'])
+    options = copy.deepcopy(SHG_MAIN.options)
+    options.update(shift=[0], write_files=False)
+    stacker = Stacker(video, 2)
+    results = sol.solex_proc(video, stacker.scan_options(options))
+    stacker.add(results)
+    mat = stacker.add(results)
+    same = np.array_equal(stacker.frames[0], stacker.frames[1])
+    stacker.discard()
+    os.remove(video)
+    bad = not np.allclose(mat, [[1, 0, 0], [0, 1, 0]], atol=1e-3) or not same
+    print(f'stack of identical scans : scale {mat[0, 0]:.4f}, shift {mat[0, 2]:.3f} {mat[1, 2]:.3f} pixels, '
+          + ('same disks' if same else 'different disks') + (' FAILED' if bad else ''))
+    return int(bad)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 3 and sys.argv[1] == 'run':
+        run(sys.argv[2], sys.argv[3:])
+    elif len(sys.argv) in (3, 4) and sys.argv[1] == 'check':
+        with open(os.path.join(sys.argv[2], FIXTURES_FILE)) as fp:
+            files = json.load(fp)
+        new_dir = tempfile.mkdtemp(prefix='shg_check_')
+        run(new_dir, files)
+        failures = compare(sys.argv[2], new_dir, float(sys.argv[3]) if len(sys.argv) == 4 else 0)
+        failures += check_stack(new_dir)
+        print('new run kept in ' + new_dir)
+        sys.exit(1 if failures else 0)
+    elif len(sys.argv) in (4, 5) and sys.argv[1] == 'compare':
+        sys.exit(1 if compare(sys.argv[2], sys.argv[3], float(sys.argv[4]) if len(sys.argv) == 5 else 0) else 0)
+    elif len(sys.argv) == 2 and sys.argv[1] == 'stack':
+        new_dir = tempfile.mkdtemp(prefix='shg_check_')
+        failures = check_stack(new_dir)
+        shutil.rmtree(new_dir)
+        sys.exit(failures)
+    else:
+        print(__doc__)
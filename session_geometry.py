@@ -0,0 +1,96 @@
+"""
+Version 19 October 2026
+
+------------------------------------------------------------------------
+Session geometry: the Y/X ratio and the tilt angle depend on the instrument setup and
+the scan speed, which stay nearly constant during an observing session.
+The geometry found by the ellipse fit of each file is recorded in a JSON file in the
+directory of the video files. Once enough files of the same session (same frame size,
+recorded within SESSION_HOURS) have been fitted, the median of their geometries is used
+for the next files, which are only checked with an ellipse fit of the limb of the
+corrected disk (see ellipse_to_circle.circle_with_geometry).
+The file is updated under a lock file: parallel workers (-j) add their geometries to it.
+------------------------------------------------------------------------
+
+"""
+import os
+import json
+import time
+import contextlib
+import traceback
+import numpy as np
+
+SESSION_FILE = 'SHG_session.json'
+SESSION_HOURS = 12 # files recorded further apart are from different sessions
+MAX_AXIS_RATIO = 1.005 # axis ratio of the corrected disk above which a known geometry is rejected (fit noise below 1.001)
+LOCK_TIMEOUT = 10 # seconds: an older lock file was left by a killed process
+
+
+@contextlib.contextmanager
+def locked(path):
+    """exclusive access to path between processes, with a lock file next to it"""
+    lock = path + '.lock'
+    while True:
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock) > LOCK_TIMEOUT:
+                    os.remove(lock)
+                    continue
+            except FileNotFoundError: # released meanwhile
+                continue
+            time.sleep(0.05)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(lock)
+
+
+class SessionGeometry:
+    """geometries fitted for the files of one directory"""
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, SESSION_FILE)
+        self.entries = self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return {}
+        except Exception:
+            traceback.print_exc()
+            print('WARNING: unreadable session file ' + self.path + ', starting a new one')
+            return {}
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as fp:
+            json.dump(self.entries, fp, sort_keys=True, indent=4)
+        os.replace(self.path + '.tmp', self.path) # never leave a half-written session file
+
+    def session_fits(self, file_, frame_size):
+        """entries of the other files of the same session"""
+        mtime = os.path.getmtime(file_)
+        return [e for name, e in self.entries.items() if name != os.path.basename(file_) and e['frame_size'] == [int(x) for x in frame_size]
+                and abs(e['mtime'] - mtime) < SESSION_HOURS * 3600]
+
+    def geometry(self, file_, frame_size, n):
+        """
+        IN : file, frame size (width, height), number of fitted files needed
+        OUT : median (Y/X ratio, tilt angle in degrees) of the session, None if fewer than n files are fitted
+        """
+        fits = self.session_fits(file_, frame_size)
+        if len(fits) < n:
+            return None
+        return float(np.median([e['ratio'] for e in fits])), float(np.median([e['slant'] for e in fits]))
+
+    def add(self, file_, frame_size, ratio, slant):
+        with locked(self.path): # entries read again: other workers may have added theirs
+            self.entries = self.load()
+            self.entries[os.path.basename(file_)] = {'frame_size': [int(x) for x in frame_size], 'mtime': os.path.getmtime(file_),
+                                                     'ratio': float(ratio), 'slant': float(slant)}
+            self.save()
@@ -0,0 +1,182 @@
+"""
+Version 19 October 2026
+
+------------------------------------------------------------------------
+Local HTTP/JSON processing service: other tools submit reconstructions without
+starting a new Python interpreter (and importing numpy, astropy, skimage ...) for
+every file. Jobs run on a pool of worker processes started once.
+
+POST /jobs       {"file": "path/to/file.ser", "options": {...}}  -> {"id": 1}
+                 options are the SHG_MAIN options, only the ones given are changed
+GET  /jobs       list of all jobs
+GET  /jobs/<id>  status (queued, running, done, failed), times, output files, error
+GET  /metrics    job counts, processing times, number of workers
+------------------------------------------------------------------------
+
+"""
+import os
+import json
+import time
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import Solex_recon as sol
+import batch_manifest
+
+
+def warm_up():
+    """run once in each worker so it is started (and its modules imported) before the first job"""
+    return os.getpid()
+
+
+def run_job(file_, options):
+    """
+    worker: process one file
+    OUT : True/False, error message, list of the files written, start time
+    """
+    start = time.time()
+    try:
+        sol.solex_proc(file_, options)
+        ok, error = True, ''
+    except Exception:
+        ok, error = False, traceback.format_exc()
+    return ok, error, batch_manifest.list_outputs(file_, start), start
+
+
+class JobQueue:
+    """jobs submitted to the worker pool, shared by the HTTP handler threads"""
+
+    def __init__(self, options, workers):
+        self.options = options
+        self.workers = workers
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+        for f in [self.pool.submit(warm_up) for _ in range(workers)]:
+            f.result()
+        self.jobs = {}
+        self.futures = {}
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def submit(self, file_, options):
+        unknown = set(options) - set(self.options)
+        if unknown:
+            raise ValueError('unknown options: ' + ', '.join(sorted(unknown)))
+        if not os.path.isfile(file_):
+            raise ValueError('file not found: ' + file_)
+        job_options = dict(self.options, **options)
+        job_options['flag_display'] = False # no graphics in background workers
+        with self.lock:
+            job_id = len(self.jobs) + 1
+            self.jobs[job_id] = {'id': job_id, 'file': os.path.abspath(file_), 'status': 'queued',
+                                 'submitted': time.time(), 'options': options}
+        future = self.pool.submit(run_job, os.path.abspath(file_), job_options)
+        with self.lock:
+            self.futures[job_id] = future
+        future.add_done_callback(lambda f: self.finish(job_id, f))
+        return job_id
+
+    def finish(self, job_id, future):
+        try:
+            ok, error, outputs, start = future.result()
+        except Exception:
+            ok, error, outputs, start = False, traceback.format_exc(), [], None
+        with self.lock:
+            job = self.jobs[job_id]
+            self.futures.pop(job_id, None)
+            job['status'] = 'done' if ok else 'failed'
+            job['started'] = start
+            job['finished'] = time.time()
+            job['outputs'] = outputs
+            if not ok:
+                job['error'] = error
+
+    def update_running(self):
+        for job_id, future in self.futures.items():
+            if future.running():
+                self.jobs[job_id]['status'] = 'running'
+
+    def get(self, job_id):
+        with self.lock:
+            self.update_running()
+            return dict(self.jobs[job_id]) if job_id in self.jobs else None
+
+    def list(self):
+        with self.lock:
+            self.update_running()
+            return [dict(job) for job in self.jobs.values()]
+
+    def metrics(self):
+        jobs = self.list()
+        durations = [j['finished'] - j['started'] for j in jobs if j.get('started') is not None and 'finished' in j]
+        counts = {}
+        for j in jobs:
+            counts[j['status']] = counts.get(j['status'], 0) + 1
+        return {
+            'workers': self.workers,
+            'uptime': time.time() - self.started,
+            'jobs': counts,
+            'processed': len(durations),
+            'mean_processing_time': sum(durations) / len(durations) if durations else None,
+            'max_processing_time': max(durations) if durations else None,
+        }
+
+
+class Handler(BaseHTTPRequestHandler):
+    queue = None
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj, indent=2).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if parts == ['jobs']:
+            self.send_json(200, self.queue.list())
+        elif len(parts) == 2 and parts[0] == 'jobs' and parts[1].isdigit():
+            job = self.queue.get(int(parts[1]))
+            if job is None:
+                self.send_json(404, {'error': 'no job ' + parts[1]})
+            else:
+                self.send_json(200, job)
+        elif parts == ['metrics']:
+            self.send_json(200, self.queue.metrics())
+        else:
+            self.send_json(404, {'error': 'unknown path ' + self.path})
+
+    def do_POST(self):
+        if self.path.strip('/') != 'jobs':
+            self.send_json(404, {'error': 'unknown path ' + self.path})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            job_id = self.queue.submit(request['file'], request.get('options', {}))
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        self.send_json(201, {'id': job_id})
+
+    def log_message(self, format, *args):
+        pass # keep the console for the processing log
+
+
+def serve(options, workers=1, port=8765):
+    """
+    run the service on localhost until interrupted (Ctrl-C)
+    IN : default options dictionary (see SHG_MAIN), number of worker processes, port
+    """
+    Handler.queue = JobQueue(options, workers)
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    print('processing service on http://127.0.0.1:' + str(port) + ' with ' + str(workers) + ' worker(s), Ctrl-C to stop')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('stopping service')
+    finally:
+        server.server_close()
+        Handler.queue.pool.shutdown(cancel_futures=True)
@@ -10,7 +10,9 @@ import matplotlib.pyplot
 from astropy.io import fits
 from scipy.interpolate import interp1d
 import os
-#import time
+import json
+import hashlib
+import time
 from scipy.signal import savgol_filter
 import cv2
 import sys
@@ -23,6 +25,18 @@ import ctypes # Modification Jean-Francois: for reading the monitor size
 import cv2
 
 mylog = []
+progress_callback = None # called with (frames read, frames to read) during the reconstruction, see set_progress_callback
+
+
+class ProcessingCancelled(Exception):
+    """processing stopped by the user (cancel button of the GUI, Escape key of the displays)"""
+
+
+def set_progress_callback(callback):
+    """callback(frames read, frames to read) is called after each frame of the reconstruction,
+    it can raise ProcessingCancelled to stop the processing; None to remove it"""
+    global progress_callback
+    progress_callback = callback
 
 
 def clearlog():
@@ -34,23 +48,17 @@ def logme(s):
     mylog.append(s + '\n')
 
 
-# read video and return constructed image of sun using fit
-def read_video_improved(file_, fit, options):
-    """take a path, a fit curve, and an dictionnary and compute everery frames asked.
+DISPLAY_PERIOD = 0.1 # seconds between two refreshes of the live display (10 Hz)
 
-    OUT :
-    Return a list containing each frame asked
-    2 integers : shape
-    1 integer : framecount
 
+class LiveDisplay:
+    """
+    live view of the reconstruction (options['flag_display']): current frame and shift 0 disk,
+    refreshed at most every DISPLAY_PERIOD seconds from 8-bit buffers decimated to the window
+    size; only the disk columns reconstructed since the last refresh are copied
     """
-    rdr = video_reader(file_)
-    ih, iw = rdr.ih, rdr.iw
-    FrameMax = rdr.FrameCount
-    disk_list = [np.zeros((ih, FrameMax), dtype='uint16')
-                 for _ in options['shift']]
 
-    if options['flag_display']:
+    def __init__(self, ih, iw, FrameMax):
         screen = tk.Tk()
         sw, sh = screen.winfo_screenwidth(), screen.winfo_screenheight()
         scaling = sh/ih * 0.8
@@ -61,6 +69,57 @@ def read_video_improved(file_, fit, options):
         cv2.namedWindow('image', cv2.WINDOW_NORMAL)
         cv2.moveWindow('image', 0, 0)
         cv2.resizeWindow('image', int(iw * scaling), int(ih * scaling))
+        self.step = max(1, math.ceil(1 / scaling)) # decimation of the buffers, 1 if the window is larger than the image
+        self.disk = np.zeros(((ih + self.step - 1) // self.step, (FrameMax + self.step - 1) // self.step), dtype='uint8')
+        self.done = 0 # disk columns already copied
+        self.last = 0.0
+
+    def update(self, img, disk, col):
+        """
+        IN : current frame, shift 0 disk, last column reconstructed
+        OUT : True if Escape is hit
+        """
+        now = time.time()
+        if now - self.last < DISPLAY_PERIOD:
+            return False
+        self.last = now
+        first = -(-self.done // self.step) # first column of the buffer not copied yet
+        self.disk[:, first:col // self.step + 1] = disk[::self.step, first * self.step:col + 1:self.step] >> 8
+        self.done = col + 1
+        cv2.imshow('image', (img[::self.step, ::self.step] >> 8).astype('uint8'))
+        cv2.imshow('disk', self.disk)
+        return cv2.waitKey(1) == 27
+
+
+# read video and return constructed image of sun using fit
+def read_video_improved(file_, fit, options):
+    """take a path, a fit curve, and an dictionnary and compute everery frames asked.
+
+    OUT :
+    Return a list containing each frame asked
+    2 integers : shape
+    1 integer : framecount
+
+    """
+    rdr = video_reader(file_, options['frame_range'], options['colour_channel'])
+    ih, iw = rdr.ih, rdr.iw
+    step = max(1, options['quick_look']) # quick look: one frame in every step frames
+    FrameMax = (rdr.FrameCount + step - 1) // step
+    # with options['velocity_map'], an extra plane holds the line centre (see LINE_CENTRE_SCALE)
+    n_planes = len(options['shift']) + (1 if options['velocity_map'] > 0 else 0)
+    if options['checkpoint_frames'] > 0:
+        disk_list, checkpoint, checkpoint_base = open_checkpoint(file_, fit, options, n_planes, ih, FrameMax)
+        rdr.seek(checkpoint['frame'] + 1)
+    else:
+        disk_list = [np.zeros((ih, FrameMax), dtype='uint16')
+                     for _ in range(n_planes)]
+
+    if options['flag_display']:
+        display = LiveDisplay(ih, iw, FrameMax)
+
+    curve = np.asarray(fit)[:, 0] + np.asarray(fit)[:, 1]
+    rows = np.arange(ih)
+    drift = compute_line_drift(file_, fit, options['line_drift'], options['frame_range'], options['colour_channel']) if options['line_drift'] else np.zeros(rdr.FrameCount)
 
     col_indeces = []
 
@@ -76,27 +135,168 @@ def read_video_improved(file_, fit, options):
         left_weights = np.ones(ih) - np.asarray(fit)[:, 1]
         right_weights = np.ones(ih) - left_weights
 
+    # Bayer files: only the pixels used are binned, unless the whole frame is needed
+    full = options['velocity_map'] > 0 or options['flag_display']
+    pixels = (lambda img, rows, cols: img[rows, cols]) if full else rdr.pixels
+
     # lance la reconstruction du disk a partir des trames
     logme('reader num frames: {}'.format(rdr.FrameCount))
     while rdr.has_frames():
-        img = rdr.next_frame()
-
-        for i in range(len(options['shift'])):
-            ind_l, ind_r = col_indeces[i]
-            left_col = img[np.arange(ih), ind_l]
-            right_col = img[np.arange(ih), ind_r]
-            IntensiteRaie = left_col * left_weights + right_col * right_weights
-            disk_list[i][:, rdr.FrameIndex] = IntensiteRaie
-
-        if options['flag_display'] and rdr.FrameIndex % 10 == 0:
-            # disk_list[1] is always shift = 0
-            cv2.imshow('image', img)
-            cv2.imshow('disk', disk_list[1])
-            if cv2.waitKey(
-                    1) == 27:                     # exit if Escape is hit
-                cv2.destroyAllWindows()
-                sys.exit()
-    return disk_list, ih, iw, rdr.FrameCount
+        img = rdr.next_frame(full)
+        col = rdr.FrameIndex // step
+
+        if options['line_drift']:
+            # per-frame sampling indices: fit + shift + measured drift of this frame
+            for i, shift in enumerate(options['shift']):
+                pos = curve + (shift + drift[rdr.FrameIndex])
+                ind_l = np.clip(np.floor(pos).astype(int), 0, iw - 2)
+                right_weights = pos - np.floor(pos)
+                left_weights = 1 - right_weights
+                IntensiteRaie = pixels(img, rows, ind_l) * left_weights + pixels(img, rows, ind_l + 1) * right_weights
+                disk_list[i][:, col] = IntensiteRaie
+        else:
+            for i in range(len(options['shift'])):
+                ind_l, ind_r = col_indeces[i]
+                left_col = pixels(img, rows, ind_l)
+                right_col = pixels(img, rows, ind_r)
+                IntensiteRaie = left_col * left_weights + right_col * right_weights
+                disk_list[i][:, col] = IntensiteRaie
+
+        if options['velocity_map'] > 0:
+            disk_list[-1][:, col] = find_line_centre(img, curve + drift[rdr.FrameIndex], options['velocity_map'])
+
+        if options['checkpoint_frames'] > 0 and (rdr.FrameIndex + 1) % options['checkpoint_frames'] == 0:
+            checkpoint['frame'] = rdr.FrameIndex
+            save_checkpoint(disk_list, checkpoint, checkpoint_base)
+
+        # disk_list[1] is always shift = 0
+        if options['flag_display'] and display.update(img, disk_list[1], col): # exit if Escape is hit
+            cv2.destroyAllWindows()
+            raise ProcessingCancelled('Escape key')
+        if progress_callback is not None:
+            progress_callback(rdr.FrameIndex + 1, rdr.FrameCount)
+        if step > 1:
+            rdr.seek(rdr.FrameIndex + step)
+    if options['checkpoint_frames'] > 0:
+        checkpoint['frame'] = int(rdr.FrameCount) - 1
+        save_checkpoint(disk_list, checkpoint, checkpoint_base)
+        disk_list = [np.array(disk) for disk in disk_list] # release the memory-mapped file
+    if step == 1:
+        disk_list = fill_dropped_frames(disk_list, rdr)
+    line_centre = disk_list.pop() if options['velocity_map'] > 0 else None
+    return disk_list, ih, iw, rdr.FrameCount, line_centre
+
+
+LINE_CENTRE_SCALE = 1000 # line centre maps are stored as uint16: 32768 + 1000 * offset from the fit in pixels
+
+
+def find_line_centre(img, curve, k):
+    """
+    sub-pixel line minimum of every row of a frame (see find_line_minima), searched within
+    +/- k columns of the fitted line
+    IN : frame, line position for every row, half-width of the search window
+    OUT : uint16 np array, offset from curve encoded with LINE_CENTRE_SCALE
+    """
+    return np.clip(32768 + LINE_CENTRE_SCALE * (find_line_minima(img, curve, k) - curve), 0, 65535)
+
+
+def decode_line_centre(img):
+    """IN : uint16 line centre map, OUT : float32 offset from the line fit in pixels"""
+    ret = img.astype('float32')
+    ret -= 32768
+    ret /= LINE_CENTRE_SCALE
+    return ret
+
+
+def open_checkpoint(file_, fit, options, n_planes, ih, FrameMax):
+    """
+    disk_list backed by a memory-mapped checkpoint file next to the video, flushed every
+    options['checkpoint_frames'] frames, so that a killed job can resume mid-scan
+    with options['resume'], the frames already in a matching checkpoint are not read again
+    IN : file path, fit, options, number of disks, disk shape
+    OUT : disk_list (memory-mapped), checkpoint state, checkpoint file base name
+    """
+    base = os.path.splitext(file_)[0] + '_checkpoint'
+    checkpoint = {'shifts': list(options['shift']), 'fit': hashlib.sha1(np.asarray(fit, dtype='d').tobytes()).hexdigest(),
+                  'line_drift': options['line_drift'], 'velocity_map': options['velocity_map'],
+                  'frames': None if options['frame_range'] is None else [int(x) for x in options['frame_range']], 'size': os.path.getsize(file_), 'frame': -1}
+    try:
+        with open(base + '.json', 'r') as fp:
+            saved = json.load(fp)
+    except Exception:
+        saved = None
+    if options['resume'] and saved is not None and os.path.exists(base + '.npy') and \
+            all(saved.get(k) == v for k, v in checkpoint.items() if k != 'frame'):
+        disks = np.load(base + '.npy', mmap_mode='r+')
+        checkpoint['frame'] = saved['frame']
+        logme('Resuming from checkpoint at frame ' + str(saved['frame'] + 1))
+    else:
+        disks = np.lib.format.open_memmap(base + '.npy', mode='w+', dtype='uint16', shape=(n_planes, int(ih), int(FrameMax)))
+    return [disks[i] for i in range(disks.shape[0])], checkpoint, base
+
+
+def save_checkpoint(disk_list, checkpoint, base):
+    disk_list[0].flush() # all the disks share the same memory-mapped file
+    with open(base + '.json.tmp', 'w') as fp:
+        json.dump(checkpoint, fp)
+    os.replace(base + '.json.tmp', base + '.json')
+
+
+def remove_checkpoint(file_):
+    base = os.path.splitext(file_)[0] + '_checkpoint'
+    for f in (base + '.npy', base + '.json'):
+        if os.path.exists(f):
+            os.remove(f)
+
+
+def measure_line_offset(img, curve, rows, window):
+    """
+    sub-pixel offset of the spectral line from the fitted curve in one frame, from the
+    line profile summed over a subset of rows in a narrow column band around the curve
+    IN : frame, fitted line position for every row, rows used, half-width of the band
+    OUT : offset in pixels (nan if no line is visible, e.g. sky frame), band brightness
+    """
+    k = np.floor(curve[rows]).astype(int)
+    f = (curve[rows] - k)[:, np.newaxis]
+    cols = np.clip(k[:, np.newaxis] + np.arange(-window, window + 2), 0, img.shape[1] - 1)
+    band = img[rows[:, np.newaxis], cols].astype('d')
+    profile = np.sum(band[:, :-1] * (1 - f) + band[:, 1:] * f, axis=0) # interpolated on the curve
+    i = np.argmin(profile)
+    edge = max(profile[0], profile[-1])
+    if i == 0 or i == profile.shape[0] - 1 or profile[i] > 0.9 * edge:
+        return np.nan, edge
+    a, b, c = profile[i - 1], profile[i], profile[i + 1]
+    den = a - 2 * b + c
+    offset = 0.5 * (a - c) / den if den > 0 else 0
+    return i - window + offset, edge
+
+
+def compute_line_drift(file_, fit, block, frames=None, channel='lum'):
+    """
+    track the drift of the spectral line through the scan (flexure, mount drift),
+    measured on one frame in every block of frames by random access
+    the offsets are relative to the brightness-weighted mean position, which is
+    the one seen in the mean image used for the polynomial fit
+    IN : file path, fit, number of frames per measurement, frame range, colour channel
+    OUT : np array, line offset in pixels for every frame
+    """
+    rdr = video_reader(file_, frames, channel)
+    curve = np.asarray(fit)[:, 0] + np.asarray(fit)[:, 1]
+    rows = np.arange(0, rdr.ih, 4)
+    window = max(3, rdr.iw // 50)
+    indices = np.arange(block // 2, rdr.FrameCount, block) if block < rdr.FrameCount else np.array([rdr.FrameCount // 2])
+    offsets = np.zeros(indices.shape[0])
+    weights = np.zeros(indices.shape[0])
+    for j, index in enumerate(indices):
+        offsets[j], weights[j] = measure_line_offset(rdr.read_frame(index), curve, rows, window)
+    valid = ~np.isnan(offsets)
+    if not np.any(valid):
+        logme('WARNING : line drift could not be measured, no drift correction')
+        return np.zeros(rdr.FrameCount)
+    offsets = offsets - np.average(offsets[valid], weights=weights[valid])
+    drift = np.interp(np.arange(rdr.FrameCount), indices[valid], offsets[valid])
+    logme('Line drift : ' + str(np.sum(valid)) + ' measures, from ' + "{:.3f}".format(np.min(drift)) + ' to ' + "{:.3f}".format(np.max(drift)) + ' pixels')
+    return drift
 
 
 def make_header(rdr):
@@ -113,8 +313,81 @@ def make_header(rdr):
     hdr['BIN1'] = 1
     hdr['BIN2'] = 1
     hdr['EXPTIME'] = 0
+    if rdr.timestamps is not None:
+        hdr['DATE-OBS'] = (ticks_to_datetime(rdr.timestamps[0]).isoformat(), 'UTC time of the first frame')
+        hdr['EXPTIME'] = (float(rdr.timestamps[-1] - rdr.timestamps[0]) / 1e7, 'scan duration (s)')
+    elif rdr.DateTime_UTC > 0:
+        hdr['DATE-OBS'] = (ticks_to_datetime(rdr.DateTime_UTC).isoformat(), 'UTC time of the recording')
     return hdr
 
+
+def fill_dropped_frames(disk_list, rdr):
+    """
+    columns of frames dropped by the camera (gaps in the time stamps longer than 1.5 frame
+    interval) are interpolated from their neighbours, so that the columns of the disks are
+    evenly spaced in time
+    IN : disks, video_reader (with time stamps)
+    OUT : disks
+    """
+    times = rdr.frame_times()
+    if times is None or times.shape[0] < 3:
+        return disk_list
+    dt = rdr.frame_interval()
+    gaps = np.diff(times) / dt
+    dropped = int(np.sum(np.round(gaps[gaps > 1.5]) - 1))
+    if dropped == 0:
+        return disk_list
+    logme('Dropped frames : ' + str(dropped) + ', interpolated from the frame time stamps')
+    positions = times / dt # column of each frame on an evenly spaced time axis
+    source = np.interp(np.arange(int(round(positions[-1])) + 1), positions, np.arange(times.shape[0]))
+    left = np.minimum(np.floor(source).astype(int), times.shape[0] - 2)
+    right_weights = (source - left).astype('float32')
+    return [(disk[:, left] * (1 - right_weights) + disk[:, left + 1] * right_weights + 0.5).astype(disk.dtype) for disk in disk_list]
+
+def find_scan_extent(file_, channel='lum', n_samples=64, level=0.05):
+    """
+    frames where the Sun crosses the slit, from the brightness of a sparse sample of frames
+    read by random access: the transitions between dark sky and Sun are then located by
+    bisection, and a margin of dark sky is kept on both sides for the geometry fit
+    IN : file path, colour channel, number of sampled frames, brightness level (fraction of the range
+    between the darkest and the brightest sample) separating sky and Sun
+    OUT : (first, last) frames, None if the Sun is always or never in the slit
+    """
+    rdr = video_reader(file_, channel=channel)
+    n = int(rdr.FrameCount)
+    if n < 2 * n_samples:
+        return None
+
+    def brightness(index):
+        return np.mean(rdr.read_frame(index)[::4, ::4])
+
+    indices = np.unique(np.linspace(0, n - 1, n_samples).astype(int))
+    values = np.array([brightness(i) for i in indices])
+    low, high = np.min(values), np.max(values)
+    if high - low < 0.5 * high: # no dark sky in the scan
+        return None
+    threshold = low + level * (high - low)
+    sun = np.flatnonzero(values > threshold)
+    a, b = sun[0], sun[-1]
+    if a == 0 and b == len(indices) - 1:
+        return None
+
+    def bisect(dark, bright):
+        # frame index of the first frame above the threshold, going from dark to bright
+        while abs(bright - dark) > 1:
+            middle = (dark + bright) // 2
+            if brightness(middle) > threshold:
+                bright = middle
+            else:
+                dark = middle
+        return bright
+
+    first = bisect(indices[a - 1], indices[a]) if a > 0 else 0
+    last = bisect(indices[b + 1], indices[b]) if b < len(indices) - 1 else n - 1
+    margin = max(10, (last - first) // 10)
+    return max(0, first - margin), min(n - 1, last + margin)
+
+
 # compute mean and max image of video
 
 def detect_bord(img, axis):
@@ -126,20 +399,78 @@ def detect_bord(img, axis):
     ub = img.shape[int(not axis)] - 1 - np.argmax(np.flip(where_sun)) # int(not axis) : get the other axis 1 -> 0 and 0 -> 1
     return lb, ub
 
-def compute_mean_max(file):
-    """IN : file path"
+def compute_mean_max(file, max_frames=None, frames=None, channel='lum'):
+    """IN : file path, maximum number of frames to read (None: all frames), frame range (None: all frames), colour channel
+    frames are sampled evenly through the scan with random access when max_frames is smaller than the number of frames"
     OUT :numpy array
     """
-    rdr = video_reader(file)
+    rdr = video_reader(file, frames, channel)
     logme('Width, Height : ' + str(rdr.Width) + ' ' + str(rdr.Height))
     logme('Number of frames : ' + str(rdr.FrameCount))
     my_data = np.zeros((rdr.ih, rdr.iw), dtype='uint64')
     max_data = np.zeros((rdr.ih, rdr.iw), dtype='uint16')
-    while rdr.has_frames():
-        img = rdr.next_frame()
-        my_data += img
-        max_data = np.maximum(max_data, img)
-    return (my_data / rdr.FrameCount).astype('uint16'), max_data
+    if max_frames is None or max_frames >= rdr.FrameCount:
+        n = rdr.FrameCount
+        while rdr.has_frames():
+            img = rdr.next_frame()
+            my_data += img
+            np.maximum(max_data, img, out=max_data)
+    else:
+        indices = np.unique(np.linspace(0, rdr.FrameCount - 1, max_frames).astype(int))
+        n = len(indices)
+        logme('Frames sampled for line detection : ' + str(n))
+        for index in indices:
+            img = rdr.read_frame(index)
+            my_data += img
+            np.maximum(max_data, img, out=max_data)
+    return (my_data / n).astype('uint16'), max_data
+
+
+def find_line_minima(img, curve=None, window=None):
+    """
+    sub-pixel position of the darkest pixel of each row, from a parabola through
+    the argmin and its two neighbours
+    IN : np array, optional curve (one column per row) and half-width of the column window
+    searched around it (None: whole row)
+    OUT : np array of floats, one column position per row
+    """
+    h, w = img.shape
+    rows = np.arange(h)
+    if curve is None:
+        k = np.argmin(img, axis=1)
+    else:
+        lo = np.clip(np.round(curve).astype(int) - window, 0, max(0, w - 1 - 2 * window))
+        cols = np.minimum(lo[:, np.newaxis] + np.arange(2 * window + 1), w - 1)
+        k = lo + np.argmin(np.take_along_axis(img, cols, axis=1), axis=1)
+    k = np.clip(k, 1, w - 2)
+    a = img[rows, k - 1].astype('d')
+    b = img[rows, k].astype('d')
+    c = img[rows, k + 1].astype('d')
+    den = a - 2 * b + c
+    offset = np.divide(0.5 * (a - c), den, out=np.zeros(h), where=den > 0)
+    return k + np.clip(offset, -0.5, 0.5)
+
+
+def robust_polyfit(x, y, deg=3, nsigma=3, max_iter=5):
+    """
+    polynomial fit with iterative rejection of points further than nsigma robust
+    standard deviations (median absolute deviation) from the fit
+    IN : np arrays, polynomial degree
+    OUT : coefficients (numpy.polynomial order, for polyval), covariance of the coefficients
+    (np.polyfit order), mask of kept points
+    """
+    keep = np.ones(x.shape[0], dtype=bool)
+    for _ in range(max_iter):
+        coef, cov = np.polyfit(x[keep], y[keep], deg, cov=True)
+        delta = y - np.polyval(coef, x)
+        sigma = 1.4826 * np.median(np.abs(delta[keep]))
+        if sigma == 0:
+            break
+        new_keep = np.abs(delta) < nsigma * sigma
+        if np.array_equal(new_keep, keep) or np.sum(new_keep) <= deg + 2:
+            break
+        keep = new_keep
+    return np.flip(np.asarray(coef, dtype='d')), cov, keep
 
 
 def compute_mean_return_fit(file, options, hdr, iw, ih, basefich0):
@@ -148,14 +479,17 @@ def compute_mean_return_fit(file, options, hdr, iw, ih, basefich0):
     Use the mean image to find the location of the spectral line of maximum darkness
     Apply a 3rd order polynomial fit to the datapoints, and return the fit, as well as the
     detected extent of the line in the y-direction.
+    The mean image is built from options['line_fit_frames'] frames sampled through the scan,
+    line minima are located to sub-pixel precision, first over the whole row and then in a
+    narrow column window around the first fit, with iterative outlier rejection.
+    The 1-sigma uncertainty of the fitted curve is logged and stored in the header (LINEERR).
     ----------------------------------------------------------------------------
     """
     flag_display = options['flag_display']
     # first compute mean image
     # rdr is the video_reader object
-    mean_img, max_img = compute_mean_max(file)
-
-    if options['save_fit']:
+    mean_img, max_img = compute_mean_max(file, options['line_fit_frames'], options['frame_range'], options['colour_channel'])
+    if options['save_fit'] and options['write_files']:
         DiskHDU = fits.PrimaryHDU(mean_img, header=hdr)
         DiskHDU.writeto(basefich0 + '_mean.fits', overwrite='True')
 
@@ -171,26 +505,30 @@ def compute_mean_return_fit(file, options, hdr, iw, ih, basefich0):
         cv2.imshow('Ser mean', mean_img)
         if cv2.waitKey(2000) == 27:                     # exit if Escape is hit
             cv2.destroyAllWindows()
-            sys.exit()
+            raise ProcessingCancelled('Escape key')
 
         cv2.destroyAllWindows()
     y1, y2 = detect_bord(max_img, axis=1) # use maximum image to detect borders
     y1 = min(max_img.shape[0]-1, y1+10)
     y2 = max(0, y2-10)
     logme('Vertical limits y1, y2 : ' + str(y1) + ' ' + str(y2))
-    min_intensity = np.argmin(mean_img, axis = 1) # use mean image to detect spectral line
-
-    p = np.flip(np.asarray(np.polyfit(np.arange(y1, y2), min_intensity[y1:y2], 3), dtype='d'))
-    # remove outlier points and get new line fit
-    delta = polyval(np.asarray(np.arange(y1,y2), dtype='d'), p) - min_intensity[y1:y2]
-    stdv = np.std(delta)
-    keep = np.abs(delta/stdv) < 3
-    p = np.flip(np.asarray(np.polyfit(np.arange(y1, y2)[keep], min_intensity[y1:y2][keep], 3), dtype='d'))
+    ys = np.arange(y1, y2)
+    min_intensity = find_line_minima(mean_img) # use mean image to detect spectral line
+    p, cov, keep = robust_polyfit(ys, min_intensity[y1:y2])
+    # refine in a narrow window around the first fit, away from other dark features
+    window = max(3, iw // 50)
+    min_intensity = find_line_minima(mean_img, polyval(np.arange(ih, dtype='d'), p), window)
+    p, cov, keep = robust_polyfit(ys, min_intensity[y1:y2])
     logme('Spectral line polynomial fit: ' + str(p))
     curve = polyval(np.asarray(np.arange(ih), dtype='d'), p)
-    np.save('curve.dat', curve)
+    vander = np.vander(ys.astype('d'), p.shape[0])
+    curve_err = np.sqrt(np.abs(np.einsum('ij,jk,ik->i', vander, cov, vander)))
+    logme('Spectral line fit: ' + str(np.sum(keep)) + ' of ' + str(keep.shape[0]) + ' rows kept, max 1-sigma error : ' + "{:.3f}".format(np.max(curve_err)) + ' pixels')
+    hdr['LINEERR'] = (float(np.max(curve_err)), 'spectral line fit 1-sigma error (pixels)')
+    if options['write_files']:
+        np.save(os.path.join(os.path.dirname(basefich0), 'curve.dat'), curve)
     fit = [[math.floor(curve[y]), curve[y] - math.floor(curve[y]), y] for y in range(ih)]
-    if not options['clahe_only']:
+    if options['write_files'] and not options['clahe_only']:
         fig = matplotlib.figure.Figure()
         ax = fig.add_subplot(1, 1, 1)
         ax.imshow(mean_img, cmap=matplotlib.pyplot.cm.gray)
@@ -257,80 +595,129 @@ def correct_transversalium2(img, circle, borders, options, not_fake, basefich):
     #plt.plot(y_s, correction_t)
     #plt.show()
 
-    c = np.ones(img.shape[0])
+    c = np.ones(img.shape[0], dtype=options['precision'])
     c[y1:y2] = correction_t
     #c[c<1] = 1
-    if not_fake and not options['clahe_only']:
+    if not_fake and options['write_files'] and not options['clahe_only']:
         fig = matplotlib.figure.Figure()
         ax = fig.add_subplot(1, 1, 1)
         ax.plot(c)
         ax.set_xlabel('y')
         ax.set_ylabel('transversalium correction factor')
         fig.savefig(basefich+'_transversalium_correction.png', dpi=300)
-    ret = (img.T * c).T # multiply each row in image by correction factor
-    ret[ret > 65535] = 65535 # prevent overflow
-    return np.array(ret, dtype='uint16')
+    ret = img * c[:, np.newaxis] # multiply each row in image by correction factor
+    np.minimum(ret, 65535, out=ret) # prevent overflow
+    return ret.astype('uint16')
 
 
 
-def apply_contrast(frame, Seuil_bas, Seuil_haut):
-    fc=(frame-Seuil_bas)* (65535/(Seuil_haut-Seuil_bas))
-    fc[fc<0]=0
-    fc[fc>65535] = 65535
+def apply_contrast(frame, Seuil_bas, Seuil_haut, dtype='float32'):
+    fc = frame.astype(dtype)
+    fc -= Seuil_bas
+    fc *= 65535/(Seuil_haut-Seuil_bas)
+    np.clip(fc, 0, 65535, out=fc)
     logme('Seuil bas       :{}'.format(np.floor(Seuil_bas)))
     logme('Seuil haut      :{}'.format(np.floor(Seuil_haut)))
     return np.array(fc, dtype='uint16')
 
-def return_frame_contrasted(frame, method):
+def get_percentiles(frame, q, hist=None):
+    """
+    percentiles of a 16-bit frame from a single histogram pass (np.bincount)
+    instead of one np.percentile partition per value; exact for integer data
+    IN : np array, list of percentiles, optional precomputed np.bincount of frame
+    OUT : np array of floats, same values as np.percentile (linear interpolation)
+    """
+    if hist is None:
+        if frame.dtype.kind != 'u' or frame.dtype.itemsize > 2:
+            return np.percentile(frame, q)
+        hist = np.bincount(frame.ravel(), minlength=65536)
+    cdf = np.cumsum(hist)
+    pos = np.asarray(q, dtype='d') / 100 * (cdf[-1] - 1)
+    lo = np.floor(pos)
+    v_lo = np.searchsorted(cdf, lo, side='right')
+    v_hi = np.searchsorted(cdf, np.minimum(lo + 1, cdf[-1] - 1), side='right')
+    return v_lo + (pos - lo) * (v_hi - v_lo)
+
+def return_frame_contrasted(frame, method, dtype='float32', stats=None):
     """
-    IN : np array, str
+    IN : np array, str, working float type, optional (25, 99.9999) percentiles
+    from get_percentiles so several methods can share one statistics pass
     OUT : np array, int, int
     """
-    frame1=np.copy(frame)
-    Seuil_bas=np.percentile(frame, 25)
-    Seuil_haut=np.percentile(frame,99.9999)
+    Seuil_bas, Seuil_haut = get_percentiles(frame, [25, 99.9999]) if stats is None else stats
     if method=='light':
         logme('Seuil bas HC    :{}'.format(np.floor(Seuil_bas)))
         logme('Seuil haut HC   :{}'.format(np.floor(Seuil_haut)))
-        return apply_contrast(frame1, Seuil_bas, Seuil_haut), Seuil_bas, Seuil_haut
+        return apply_contrast(frame, Seuil_bas, Seuil_haut, dtype), Seuil_bas, Seuil_haut
 
     elif method=='strong' :
         # image seuils serres
         Seuil_bas=(Seuil_haut*0.25)
-        Seuil_haut=np.percentile(frame1,99.9999)
         logme('Seuil bas HC    :{}'.format(np.floor(Seuil_bas)))
         logme('Seuil haut HC   :{}'.format(np.floor(Seuil_haut)))
-        return apply_contrast(frame1, Seuil_bas, Seuil_haut), Seuil_bas, Seuil_haut
+        return apply_contrast(frame, Seuil_bas, Seuil_haut, dtype), Seuil_bas, Seuil_haut
 
     elif method=='protu' :
         Seuil_bas=0
-        Seuil_haut=np.percentile(frame1,99.9999)*0.18
+        Seuil_haut=Seuil_haut*0.18
         logme('Seuil bas protu :{}'.format(np.floor(Seuil_bas)))
         logme('Seuil haut protu:{}'.format(np.floor(Seuil_haut)))
-        return apply_contrast(frame1, Seuil_bas, Seuil_haut), Seuil_bas, Seuil_haut
+        return apply_contrast(frame, Seuil_bas, Seuil_haut, dtype), Seuil_bas, Seuil_haut
 
     elif method=='clahe':
-        Seuil_bas=np.percentile(frame1, 25)
-        Seuil_haut=np.percentile(frame1,99.9999)*1.05
-        return apply_contrast(frame1, Seuil_bas, Seuil_haut), Seuil_bas, Seuil_haut
+        Seuil_haut=Seuil_haut*1.05
+        return apply_contrast(frame, Seuil_bas, Seuil_haut, dtype), Seuil_bas, Seuil_haut
 
 
 
 
+def crop_width(img, cercle, options):
+    """
+    crop or pad the width of an image around the disk centre (options['fixed_width'],
+    options['crop_width_square']), unchanged if neither is set
+    IN : image, circle (-1, -1, -1 if not found), options
+    OUT : image, circle in the new image
+    """
+    if options['fixed_width'] is None and not options['crop_width_square']:
+        return img, cercle
+    h, w = img.shape
+
+    nw = h if options['fixed_width'] is None else options['fixed_width'] # new width
+    nh=h
+    if options['crop_width_square']:
+        nh= nw
+
+    nw2 = nw // 2
+    cx = w // 2 if cercle == (-1, -1, -1) else int(cercle[0])
+    x0 = cx - nw2 # column of img at the left of the new image
+
+    # single copy into the new image, columns outside img filled with img[0, 0]
+    new_img = np.full((nh, nw), img[0, 0], dtype=img.dtype)
+    left, right = max(0, x0), min(cx + nw2, w)
+    new_img[:, left - x0:right - x0] = img[(h-nh)//2:(h+nh)//2, left:right]
+
+    if not cercle == (-1, -1, -1):
+        cercle = (nw2, nh//2, cercle[2])
+    return new_img, cercle
+
+
 def image_process(frame, cercle, options, header, basefich):
     # create a CLAHE object (Arguments are optional)
     # clahe = cv2.createCLAHE(clipLimit=0.8, tileGridSize=(5,5))
     clahe = cv2.createCLAHE(clipLimit=0.8, tileGridSize=(2,2))
     cl1 = clahe.apply(frame)
 
+    # percentiles shared by the light, strong and protus contrasts
+    stats = get_percentiles(frame, [25, 99.9999])
+
     #light contrast
-    frame_contrasted,sb,sh=return_frame_contrasted(frame, "light")
+    frame_contrasted,sb,sh=return_frame_contrasted(frame, "light", options['precision'], stats)
 
     #high contrast
-    frame_contrasted2,sb,sh=return_frame_contrasted(frame, "strong")
+    frame_contrasted2,sb,sh=return_frame_contrasted(frame, "strong", options['precision'], stats)
 
     # image seuils protus
-    frame_contrasted3,sb,sh=return_frame_contrasted(frame, "protu")
+    frame_contrasted3,sb,sh=return_frame_contrasted(frame, "protu", options['precision'], stats)
 
     if not cercle == (-1, -1, -1) and options['disk_display']:
         x0=int(cercle[0])
@@ -339,19 +726,19 @@ def image_process(frame, cercle, options, header, basefich):
         if r > 0:
             frame_contrasted3=cv2.circle(frame_contrasted3, (x0,y0),r,80,-1)
 
-    cc,sb,sh=return_frame_contrasted(cl1, 'clahe')
+    cc,sb,sh=return_frame_contrasted(cl1, 'clahe', options['precision'])
 
-    # handle rotations
+    # handle rotations (np.rot90 gives views, the png writer makes the only copy)
     cc = np.rot90(cc, options['img_rotate']//90, axes=(0,1))
     frame_contrasted = np.rot90(frame_contrasted, options['img_rotate']//90, axes=(0,1))
     frame_contrasted2 = np.rot90(frame_contrasted2, options['img_rotate']//90, axes=(0,1))
     frame_contrasted3 = np.rot90(frame_contrasted3, options['img_rotate']//90, axes=(0,1))
-    frame = np.rot90(frame, options['img_rotate']//90, axes=(0,1))
 
     # sauvegarde en png de clahe
-    cv2.imwrite(basefich+'_clahe.png',cc)   # Modification Jean-Francois: placed before the IF for clear reading
+    if options['write_files']:
+        cv2.imwrite(basefich+'_clahe.png',cc)   # Modification Jean-Francois: placed before the IF for clear reading
 
-    if not options['clahe_only']:
+    if options['write_files'] and not options['clahe_only']:
         # sauvegarde en png pour appliquer une colormap par autre script
 
         #cv2.imwrite(basefich+'_disk.png',frame_contrasted)
@@ -376,10 +763,92 @@ def image_process(frame, cercle, options, header, basefich):
         cv2.destroyAllWindows()
 
     # sauvegarde le fits
-    if options['save_fit']:
-        frame2=np.copy(frame)
+    if options['save_fit'] and options['write_files']:
         frame2=np.array(cl1, dtype='uint16')
         DiskHDU=fits.PrimaryHDU(frame2,header)
         DiskHDU.writeto(basefich+ '_clahe.fits', overwrite='True')
 
+    return {'disk': frame_contrasted, 'diskHC': frame_contrasted2, 'protus': frame_contrasted3, 'clahe': cc}
+
 
+
+
+def doppler_pairs(shifts, options):
+    """
+    IN : user pixel shifts, options
+    OUT : list of (negative shift, positive shift) pairs giving a dopplergram: (-n, n) for
+    options['doppler_picture'] = n, and every symmetric pair of the shifts with options['doppler_sweep']
+    """
+    pairs = []
+    if options['doppler_sweep']:
+        pairs = [(-s, s) for s in sorted(set(shifts)) if s > 0 and -s in shifts]
+    d = options['doppler_picture']
+    if d > 0 and (-d, d) not in pairs:
+        pairs.append((-d, d))
+    return pairs
+
+
+def make_dopplergrams(images, pairs, options, header, basefich0):
+    """
+    dopplergrams of several pairs of shifts at once: the blue channel is the negative shift,
+    the green one the mean of the two, the red one the positive shift, all with the 'strong'
+    contrast of the mean image of the pair
+    IN : {shift: corrected image}, list of (negative shift, positive shift), options, fits header, base file name
+    OUT : {pair: RGB dopplergram (uint16)}
+    """
+    neg = np.stack([images[a] for a, b in pairs])
+    pos = np.stack([images[b] for a, b in pairs])
+    mean = ((neg.astype('uint32') + pos) // 2).astype('uint16')
+
+    # same thresholds as return_frame_contrasted(mean, 'strong'), one histogram pass per pair
+    Seuil_haut = np.array([get_percentiles(m, [99.9999])[0] for m in mean])
+    Seuil_bas = Seuil_haut * 0.25
+    gain = (65535 / (Seuil_haut - Seuil_bas)).astype(options['precision'])[:, np.newaxis, np.newaxis]
+    offset = Seuil_bas.astype(options['precision'])[:, np.newaxis, np.newaxis]
+
+    dopplergrams = np.empty(mean.shape + (3,), dtype='uint16')
+    for channel, stack in enumerate((neg, mean, pos)):
+        fc = stack.astype(options['precision'])
+        fc -= offset
+        fc *= gain
+        np.clip(fc, 0, 65535, out=fc)
+        dopplergrams[..., channel] = fc
+
+    for k, (a, b) in enumerate(pairs):
+        logme(f'Dopplergram {a}, {b} : seuil bas {np.floor(Seuil_bas[k])}, seuil haut {np.floor(Seuil_haut[k])}')
+        if not options['write_files']:
+            continue
+        basefich = f"{basefich0}_shift={b if a == -b else str(a) + '_' + str(b)}_DOPPLERGRAM"
+        if not options['clahe_only']:
+            fits.PrimaryHDU(neg[k], header=header).writeto(basefich + '_neg.fits', overwrite='True')
+            fits.PrimaryHDU(mean[k], header=header).writeto(basefich + '_mean.fits', overwrite='True')
+            fits.PrimaryHDU(pos[k], header=header).writeto(basefich + '_pos.fits', overwrite='True')
+        cv2.imwrite(basefich + '.png', dopplergrams[k])
+    return {pair: dopplergrams[k] for k, pair in enumerate(pairs)}
+
+
+def make_line_centre_map(line_centre, cercle, options, header, basefich0):
+    """
+    line centre map: offset of the line minimum from the line fit, in pixels, positive
+    to the right of the spectrum (red side if the spectrum is not mirrored). Set to 0
+    outside the disk when the disk is found. The png is grey for 0, from black to white
+    over +/- the 99.5 percentile of the offsets on the disk
+    IN : geometry corrected line centre map (uint16, see LINE_CENTRE_SCALE), circle, options, fits header, base file name
+    OUT : float32 line centre map
+    """
+    offsets = decode_line_centre(line_centre)
+    if not cercle == (-1, -1, -1):
+        y, x = np.ogrid[:offsets.shape[0], :offsets.shape[1]]
+        offsets[(x - cercle[0])**2 + (y - cercle[1])**2 > cercle[2]**2] = 0
+        on_disk = offsets[offsets != 0]
+    else:
+        on_disk = offsets.ravel()
+    scale = max(np.percentile(np.abs(on_disk), 99.5), 1 / LINE_CENTRE_SCALE) if on_disk.size else 1
+    logme(f'Line centre map : +/- {scale:.3f} pixels')
+    if options['write_files']:
+        hdr = header.copy()
+        hdr['BUNIT'] = 'pixel'
+        hdr['COMMENT'] = 'line centre offset from the line fit'
+        fits.PrimaryHDU(offsets, header=hdr).writeto(basefich0 + '_linecentre.fits', overwrite='True')
+        cv2.imwrite(basefich0 + '_linecentre.png', np.clip(32768 + offsets * (32767 / scale), 0, 65535).astype('uint16'))
+    return offsets
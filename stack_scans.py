@@ -0,0 +1,152 @@
+"""
+Version 19 October 2026
+
+------------------------------------------------------------------------
+Stacking of several scans of the same target: the circularized disks of each scan
+are registered on the first one using the circles found by the ellipse fit (centre
+and radius), refined with a sub-pixel cross-correlation (rejected if larger than the
+offset of the circle fitted to the registered limb from the first circle), and combined with a mean, a median
+or a sigma-clipped mean.
+The registered disks are kept in a memory-mapped file next to the first video and
+combined by strips of rows, so that memory stays bounded by a few images whatever
+the number of scans.
+------------------------------------------------------------------------
+
+"""
+import os
+import numpy as np
+import cv2
+from astropy.io import fits
+from skimage.registration import phase_cross_correlation
+
+from solex_util import logme, image_process
+from ellipse_to_circle import coarse_factor, downscaled_edge_list, refine_limb, clip_limb, fit_circle
+
+STACK_METHODS = ('mean', 'median', 'sigma')
+UPSAMPLE = 100 # sub-pixel registration to 1 / UPSAMPLE pixel
+LIMB_TOLERANCE = 0.5 # pixels: accuracy of the circle fitted to the limb of a registered disk
+
+
+class Stacker:
+    """registered disks of several scans, added one scan at a time (see Solex_recon.solex_proc results)"""
+
+    def __init__(self, file_, n_scans, method='mean', nsigma=3.0):
+        if method not in STACK_METHODS:
+            raise ValueError('unknown stacking method ' + str(method) + ', use one of ' + ', '.join(STACK_METHODS))
+        self.base = os.path.splitext(file_)[0] + '_stack'
+        self.n_scans = n_scans
+        self.method = method
+        self.nsigma = nsigma
+        self.count = 0
+        self.frames = None
+
+    def scan_options(self, options):
+        """options for solex_proc"""
+        return dict(options, keep_arrays=True)
+
+    def add(self, results):
+        """
+        register the disks of one scan and store them
+        IN : solex_proc results, with options['keep_arrays']
+        OUT : affine matrix applied to the disks of the scan
+        """
+        shifts = sorted(results['shifts'])
+        images = [results['shifts'][s]['detransversaliumed'] for s in shifts]
+        if self.frames is None:
+            self.shifts = shifts
+            self.header = results['header']
+            self.circle = results['circle']
+            self.shape = images[0].shape
+            self.frames = np.lib.format.open_memmap(self.base + '.npy', mode='w+', dtype='uint16',
+                                                    shape=(self.n_scans, len(shifts)) + self.shape)
+        elif shifts != self.shifts:
+            raise ValueError('all the stacked scans need the same pixel shifts')
+
+        mat = self.circle_transform(results['circle'])
+        registered = cv2.warpAffine(images[0], mat, self.shape[::-1], flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        if self.count > 0:
+            # sub-pixel refinement on the first shift, the same for all the shifts of the scan
+            # (cross-correlation: the phase correlation is less accurate on these smooth disks)
+            (dy, dx), *_ = phase_cross_correlation(np.float32(self.frames[0, 0]), np.float32(registered),
+                                                   upsample_factor=UPSAMPLE, normalization=None)
+            residual = self.circle_residual(registered)
+            if np.hypot(dx, dy) <= residual + LIMB_TOLERANCE:
+                mat[:, 2] += (dx, dy)
+            else:
+                logme(f'WARNING : stack scan {self.count + 1} : correlation shift {dx:.2f} {dy:.2f} larger than the circle registration residual {residual:.2f} pixels, not used')
+            logme(f'Stack scan {self.count + 1} : scale {mat[0, 0]:.4f}, shift {mat[0, 2]:.2f} {mat[1, 2]:.2f} pixels')
+        for k, img in enumerate(images):
+            self.frames[self.count, k] = cv2.warpAffine(img, mat, self.shape[::-1], flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        self.frames.flush()
+        self.count += 1
+        return mat
+
+    def discard(self):
+        """remove the memory-mapped file without combining the scans (batch cancelled)"""
+        if self.frames is not None:
+            del self.frames
+            self.frames = None
+            os.remove(self.base + '.npy')
+
+    def circle_transform(self, circle):
+        """affine matrix bringing circle onto the circle of the first scan (translation only if a circle is missing)"""
+        if self.count == 0 or circle == (-1, -1, -1) or self.circle == (-1, -1, -1):
+            return np.float32([[1, 0, 0], [0, 1, 0]])
+        scale = self.circle[2] / circle[2]
+        return np.float32([[scale, 0, self.circle[0] - scale * circle[0]],
+                           [0, scale, self.circle[1] - scale * circle[1]]])
+
+    def circle_residual(self, image):
+        """
+        residual of the circle registration: distance (pixels) between the circle fitted to the
+        full-resolution limb of a registered disk and the circle of the first scan
+        IN : registered disk, OUT : distance, inf without circle
+        """
+        if self.circle == (-1, -1, -1):
+            return np.inf
+        factor = coarse_factor(image)
+        limb = clip_limb(refine_limb(image, downscaled_edge_list(image, factor)[0], np.array([self.circle[1], self.circle[0]]), factor))
+        if limb.shape[0] < 3:
+            return np.inf
+        centre, radius = fit_circle(limb[:, ::-1])
+        return float(np.hypot(*(centre - self.circle[:2])) + abs(radius - self.circle[2]))
+
+    def combine(self, frames):
+        """IN : (scans, rows, columns) array, OUT : combined rows (float32)"""
+        if self.method == 'mean':
+            return frames.mean(axis=0, dtype='float32')
+        if self.method == 'median':
+            return np.median(frames, axis=0).astype('float32')
+        data = frames.astype('float32')
+        mask = np.ones(data.shape, dtype=bool)
+        for _ in range(3):
+            masked = np.ma.masked_array(data, ~mask)
+            centre, sigma = np.ma.median(masked, axis=0), masked.std(axis=0)
+            mask = np.abs(data - centre) <= self.nsigma * sigma + 0.5
+        return np.ma.masked_array(data, ~mask).mean(axis=0).filled(0).astype('float32')
+
+    def finish(self, options):
+        """
+        combine the stored scans, process and save one image per pixel shift, remove the memory-mapped file
+        OUT : {shift: stacked image (uint16)}
+        """
+        if self.frames is None:
+            return {}
+        logme(f'Stacking {self.count} scans : {self.method}')
+        strip = max(1, self.shape[0] // max(1, self.count)) # rows combined at once: about one image in memory
+        hdr = self.header.copy()
+        hdr['NSTACK'] = self.count
+        stacked = {}
+        for k, shift in enumerate(self.shifts):
+            out = np.empty(self.shape, dtype='uint16')
+            for y in range(0, self.shape[0], strip):
+                out[y:y + strip] = np.clip(np.rint(self.combine(self.frames[:self.count, k, y:y + strip])), 0, 65535)
+            basefich = self.base + str(self.count) + '_shift=' + str(shift)
+            if options['write_files']:
+                fits.PrimaryHDU(out, header=hdr).writeto(basefich + '.fits', overwrite='True')
+            image_process(out, self.circle, options, hdr, basefich)
+            stacked[shift] = out
+        del self.frames
+        self.frames = None
+        os.remove(self.base + '.npy')
+        return stacked
@@ -4,12 +4,34 @@ contributors: Valerie Desnoux, Matt Considine
 Version 30 June 2022
 
 """
+import os
+import datetime
 import numpy as np
 import cv2 #MattC
+from camera_db import find_camera
+
+
+def ticks_to_datetime(ticks):
+    """SER time stamps: ticks of 100 ns since 1 January of year 1"""
+    return datetime.datetime(1, 1, 1) + datetime.timedelta(microseconds=int(ticks) // 10)
+
+
+# SER ColorID of the Bayer matrices: colour of the pixels (0, 0), (0, 1), (1, 0), (1, 1) of each 2x2 block
+BAYER_PATTERNS = {8: 'RGGB', 9: 'GRBG', 10: 'GBRG', 11: 'BGGR', 16: 'CYYM', 17: 'YCMY', 18: 'YMCY', 19: 'MYYC'}
+RGB_PLANES = {100: 'RGB', 101: 'BGR'}
+_depth_shifts = {} # (path, size, modification time) -> shift scaling the data to 16 bits, see video_reader.find_depth_shift
 
 class video_reader:
 
-    def __init__(self, file_):
+    def __init__(self, file_, frames=None, channel='lum'):
+        """
+        IN : file path, optional (first, last) frame range: the reader then only sees these
+        frames, numbered from 0, colour channel of colour files ('R', 'G', 'B' or 'lum')
+        Bayer files give frames of half width and height, without demosaicing: each pixel
+        is a 2x2 block of the colour matrix (mean of the pixels of the channel, or of all
+        of them for 'lum')
+        """
+        self.channel = channel
         # ouverture et lecture de l'entete du fichier ser
         self.file_ = file_
         
@@ -59,25 +81,40 @@ class video_reader:
             offset=offset+40
 
             self.Telescope= np.fromfile(file_, dtype='int8', count=40,offset=offset).tobytes().decode().strip()
+            offset=offset+40
+
+            self.DateTime, self.DateTime_UTC = np.fromfile(file_, dtype='<i8', count=2, offset=offset)
 
+            self.planes = 3 if int(self.ColorID[0]) in RGB_PLANES else 1
             if self.PixelDepthPerPlane==8:
                 self.infiledatatype='uint8'
-                self.count=self.Width*self.Height       # Nombre d'octet d'une trame
+                self.count=self.Width*self.Height*self.planes       # Nombre d'octet d'une trame
                 self.infilebytes=1
             else:
                 self.infiledatatype='uint16'
-                self.count=self.Width*self.Height      # Nombre d'octet d'une trame
+                self.count=self.Width*self.Height*self.planes      # Nombre d'octet d'une trame
                 self.infilebytes=2
             self.FrameIndex=-1             # Index de trame, on evite les deux premieres
             self.offset=178               # Offset de l'entete fichier ser
             self.fileoffset=178 #MattC to avoid stomping on offset accumulator
+            self.depth_shift = self.find_depth_shift() if self.infilebytes == 2 and self.FrameCount > 0 else 0
+
+            # optional trailer of UTC time stamps (one int64 per frame), read at once
+            self.timestamps = None
+            trailer = self.fileoffset + int(self.FrameCount) * self.count * self.infilebytes
+            if os.path.getsize(file_) >= trailer + 8 * int(self.FrameCount):
+                timestamps = np.fromfile(file_, dtype='<i8', count=int(self.FrameCount), offset=trailer)
+                if timestamps.size and np.all(timestamps > 0):
+                    self.timestamps = timestamps
             
         elif self.AVI_flag: #MattC 
     	    #deal with avi file
             self.file_ = cv2.VideoCapture(file_)
 
-            self.Width = int(self.file.get(cv2.CAP_PROP_FRAME_WIDTH))
-            self.Height = int(self.file.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            self.Width = int(self.file_.get(cv2.CAP_PROP_FRAME_WIDTH))
+            self.Height = int(self.file_.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            self.ColorID = np.array([101]) # frames decoded as BGR
+            self.planes = 3
             self.PixelDepthPerPlane=1*8
             self.FrameCount = int(self.file_.get(cv2.CAP_PROP_FRAME_COUNT))
             self.count=self.Width*self.Height
@@ -85,19 +122,69 @@ class video_reader:
             self.FrameIndex=-1
             self.offset = 0
             self.fileoffset = 0 #MattC to avoid stomping on offset accumulator
+            self.depth_shift = 0
+            self.DateTime, self.DateTime_UTC = 0, 0
+            self.timestamps = None
         else: #MattC
     	    ok_flag = False
 
-        if self.Width > self.Height:
+        self.first_frame = 0
+        if frames is not None:
+            self.first_frame = max(0, int(frames[0]))
+            self.FrameCount = max(0, min(int(frames[1]), int(self.FrameCount) - 1) - self.first_frame + 1)
+            self.fileoffset += self.first_frame * self.count * self.infilebytes
+            if self.timestamps is not None:
+                self.timestamps = self.timestamps[self.first_frame:self.first_frame + self.FrameCount]
+            if self.AVI_flag:
+                self.file_.set(cv2.CAP_PROP_POS_FRAMES, self.first_frame)
+
+        self.bayer = BAYER_PATTERNS.get(int(self.ColorID[0]))
+        self.channel_bin = 2 if self.bayer is not None else 1 # Bayer frames are binned 2x2
+        if self.bayer is not None:
+            # pixels of each 2x2 block used: the ones of the channel, all of them for luminance
+            offsets = [(k // 2, k % 2) for k, c in enumerate(self.bayer) if c == channel]
+            self.bayer_offsets = offsets if offsets else [(k // 2, k % 2) for k in range(4)]
+        elif self.planes == 3:
+            order = RGB_PLANES[int(self.ColorID[0])]
+            self.plane_index = [order.index(channel)] if channel in order else [0, 1, 2]
+        width, height = self.Width // self.channel_bin, self.Height // self.channel_bin
+        if width > height:
             self.flag_rotate = True
-            self.ih = self.Width
-            self.iw = self.Height
+            self.ih = width
+            self.iw = height
         else:
             self.flag_rotate = False
-            self.iw = self.Width
-            self.ih = self.Height
+            self.iw = width
+            self.ih = height
 
-    def next_frame(self):
+    def find_depth_shift(self):
+        """
+        shift scaling 10 to 15-bit data to 16 bits: the depth of the header, or of the camera list
+        if the header says 16 bits or nothing. Data already aligned on the most significant bits
+        (lowest bits all zero in the middle frame) or with values above the depth are not shifted.
+        Found once per file (cached on the path, size and date of the file)
+        """
+        st = os.stat(self.file_)
+        key = (os.path.abspath(self.file_), st.st_size, st.st_mtime)
+        if key not in _depth_shifts:
+            depth = int(self.PixelDepthPerPlane)
+            if not 8 < depth < 16:
+                camera = find_camera(self.Observer, self.Telescope, self.Instrument)
+                depth = int(camera['bit_depth']) if camera is not None and camera['bit_depth'] is not None and 8 < camera['bit_depth'] < 16 else 16
+            shift = 0
+            if depth < 16:
+                middle = np.fromfile(self.file_, dtype='uint16', count=self.count,
+                                     offset=self.fileoffset + (self.FrameCount // 2) * self.count * self.infilebytes)
+                if middle.size and np.any(middle & (2**(16 - depth) - 1)) and middle.max() < 2**depth:
+                    shift = 16 - depth
+            _depth_shifts[key] = shift
+        return _depth_shifts[key]
+
+    def next_frame(self, full=True):
+        """
+        IN : full=False returns Bayer frames as read, not binned, for pixels (the other frames are the same)
+        OUT : next frame
+        """
         self.FrameIndex += 1
         self.offset = self.fileoffset + self.FrameIndex * self.count * self.infilebytes #MattC track offset
       
@@ -109,21 +196,91 @@ class video_reader:
                 offset=self.offset)
         elif self.AVI_flag:
             ret, img = self.file_.read()
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
         else:
             raise Exception('error input file is neither is SER nor AVI')
 
-        img = np.reshape(img, (self.Height, self.Width))
-        
+        if not full and self.bayer is not None:
+            return np.reshape(img, (self.Height, self.Width))
+        return self.format_frame(img)
+
+    def read_frame(self, index):
+        """random access to frame number index, without moving the next_frame position (SER)"""
+        if self.SER_flag:
+            img = np.fromfile(
+                self.file_,
+                dtype = self.infiledatatype,
+                count = self.count,
+                offset = self.fileoffset + index * self.count * self.infilebytes)
+        elif self.AVI_flag:
+            self.file_.set(cv2.CAP_PROP_POS_FRAMES, self.first_frame + index)
+            ret, img = self.file_.read()
+        else:
+            raise Exception('error input file is neither is SER nor AVI')
+
+        return self.format_frame(img)
+
+    def format_frame(self, img):
+        if self.planes == 3:
+            img = np.reshape(img, (self.Height, self.Width, 3))
+            if len(self.plane_index) == 1:
+                img = img[:, :, self.plane_index[0]]
+            elif self.AVI_flag:
+                img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            else:
+                img = (img.sum(axis=2, dtype='uint32') // 3).astype(img.dtype)
+        else:
+            img = np.reshape(img, (self.Height, self.Width))
+        if self.bayer is not None:
+            # 2x2 binning of the pixels of the channel, no demosaicing
+            h, w = self.Height // 2 * 2, self.Width // 2 * 2
+            binned = sum(img[dy:h:2, dx:w:2].astype('uint32') for dy, dx in self.bayer_offsets)
+            img = (binned // len(self.bayer_offsets)).astype(img.dtype)
+
         if self.flag_rotate:
             img = np.rot90(img)
+        return self.scale_depth(img)
+
+    def scale_depth(self, img):
         if self.infiledatatype == 'uint8':
             img = np.asarray(img, dtype='uint16')*256 #upscale 8-bit to 16-bit
+        elif self.depth_shift:
+            img = np.minimum(img, 65535 >> self.depth_shift) << self.depth_shift #upscale 10 to 15-bit to 16-bit, saturated
         return img
 
+    def pixels(self, frame, rows, cols):
+        """
+        pixels (rows, cols) of a frame of next_frame(full=False): for Bayer files, only these
+        pixels are binned, the same values as format_frame
+        IN : frame, row and column indices in the formatted frame
+        """
+        if self.bayer is None:
+            return frame[rows, cols]
+        if self.flag_rotate:
+            rows, cols = cols, self.ih - 1 - rows # before np.rot90
+        binned = sum(frame[2 * rows + dy, 2 * cols + dx].astype('uint32') for dy, dx in self.bayer_offsets)
+        return self.scale_depth((binned // len(self.bayer_offsets)).astype(frame.dtype))
+
+    def seek(self, index):
+        """next_frame will return frame number index"""
+        self.FrameIndex = index - 1
+        if self.AVI_flag:
+            self.file_.set(cv2.CAP_PROP_POS_FRAMES, self.first_frame + index)
+
     def has_frames(self):
         return self.FrameIndex + 1 < self.FrameCount
 
+    def frame_times(self):
+        """time of each frame in seconds from the first one, None without time stamps"""
+        if self.timestamps is None:
+            return None
+        return (self.timestamps - self.timestamps[0]) / 1e7
+
+    def frame_interval(self):
+        """median time between two frames in seconds, None without time stamps"""
+        if self.timestamps is None or self.timestamps.shape[0] < 2:
+            return None
+        return float(np.median(np.diff(self.timestamps))) / 1e7
+
 if __name__ == '__main__':
     import sys
     if len(sys.argv)==2 :
@@ -0,0 +1,139 @@
+"""
+Version 19 October 2026
+
+------------------------------------------------------------------------
+Watch-folder mode: reconstruct every SER or AVI file written to one or more directories
+during an observing session.
+- the directories are polled (no extra dependency, works the same on Windows and Linux)
+- a file is queued once its size and date have not changed for a few seconds and,
+  for SER files, once all the frames announced in the header are written
+- files are processed by a pool of worker processes
+- a job state file in each directory records each file (size, date, status), so that a
+  restart neither reprocesses finished files nor skips new or interrupted ones
+------------------------------------------------------------------------
+
+"""
+import os
+import json
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import Solex_recon as sol
+from video_reader import video_reader
+
+STATE_FILE = 'SHG_watch_state.json'
+
+
+def process_file(file_, options):
+    """worker: process one file, return (True, '') or (False, error message)"""
+    try:
+        sol.solex_proc(file_, options)
+        return True, ''
+    except Exception:
+        return False, traceback.format_exc()
+
+
+def read_state(directory):
+    try:
+        with open(os.path.join(directory, STATE_FILE), 'r') as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return {}
+    except Exception:
+        traceback.print_exc()
+        print('WARNING: unreadable job state file, starting a new one')
+        return {}
+
+
+def write_state(directory, state):
+    path = os.path.join(directory, STATE_FILE)
+    with open(path + '.tmp', 'w') as fp:
+        json.dump(state, fp, sort_keys=True, indent=4)
+    os.replace(path + '.tmp', path) # never leave a half-written state file
+
+
+def list_videos(directory):
+    """
+    IN : directory
+    OUT : dictionary file name -> (size, modification time) of the SER and AVI files
+    """
+    videos = {}
+    for entry in os.scandir(directory):
+        if entry.is_file() and entry.name.split('.')[-1].upper() in ('SER', 'AVI'):
+            st = entry.stat()
+            videos[entry.name] = (st.st_size, st.st_mtime)
+    return videos
+
+
+def is_complete(file_, size):
+    """a SER file is complete when all the frames announced in its header are written"""
+    if not file_.upper().endswith('.SER'):
+        return True
+    try:
+        rdr = video_reader(file_)
+    except Exception:
+        return False # header not written yet
+    return rdr.FrameCount == 0 or size >= rdr.fileoffset + int(rdr.FrameCount) * rdr.count * rdr.infilebytes
+
+
+def watch(directories, options, workers=1, poll=2.0, settle=5.0):
+    """
+    watch the directories and process new files until interrupted (Ctrl-C)
+    IN : list of directories, options dictionary (see SHG_MAIN), number of worker processes
+    shared by all the directories, polling period and time a file must stay unchanged before
+    it is queued (seconds)
+    """
+    directories = [os.path.abspath(d) for d in directories]
+    options = dict(options, flag_display=False) # no graphics in background workers
+    states = {directory: read_state(directory) for directory in directories}
+    seen = {} # (directory, name) -> (size, mtime, time since when unchanged)
+    running = {} # future -> (directory, name)
+    print('watching ' + ', '.join(directories) + ' with ' + str(workers) + ' worker(s), Ctrl-C to stop')
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        try:
+            while True:
+                changed = set()
+                now = time.time()
+                in_progress = set(running.values())
+                for directory in directories:
+                    state = states[directory]
+                    for name, (size, mtime) in list_videos(directory).items():
+                        key = (directory, name)
+                        info = state.get(name)
+                        if key in in_progress:
+                            continue
+                        if info is not None and info['status'] in ('done', 'failed') and info['size'] == size and info['mtime'] == mtime:
+                            continue
+                        if key not in seen or seen[key][:2] != (size, mtime):
+                            seen[key] = (size, mtime, now)
+                            continue
+                        if now - seen[key][2] < settle or not is_complete(os.path.join(directory, name), size):
+                            continue
+                        del seen[key]
+                        print('queued: ' + os.path.join(directory, name))
+                        state[name] = {'status': 'running', 'size': size, 'mtime': mtime}
+                        running[pool.submit(process_file, os.path.join(directory, name), options.copy())] = key
+                        changed.add(directory)
+
+                for future in [f for f in running if f.done()]:
+                    directory, name = running.pop(future)
+                    ok, error = future.result()
+                    info = states[directory][name]
+                    info['status'] = 'done' if ok else 'failed'
+                    info['finished'] = time.strftime('%Y-%m-%d %H:%M:%S')
+                    if not ok:
+                        info['error'] = error.strip().split('\n')[-1]
+                        print('ERROR processing ' + os.path.join(directory, name) + ':\n' + error)
+                    else:
+                        print('done: ' + os.path.join(directory, name))
+                    changed.add(directory)
+
+                for directory in changed:
+                    write_state(directory, states[directory])
+                time.sleep(poll)
+        except KeyboardInterrupt:
+            print('stopping: files being processed will be processed again on restart')
+            for future in running:
+                future.cancel()
+